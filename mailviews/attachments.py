@@ -0,0 +1,226 @@
+"""
+File-backed message attachments, which are read and encoded when a message
+is serialized rather than when it is rendered, so unsent messages don't hold
+the content of their attachments.
+
+Encoded content is cached by a hash of the content, so an attachment that is
+sent with many messages (such as a logo or a terms of service document) is
+only encoded once, even when it is attached from a different path or file
+object.
+"""
+import hashlib
+import mimetypes
+import mmap
+import os
+import threading
+from email.mime.base import MIMEBase
+
+from django.utils import six
+from django.utils.encoding import force_str
+
+from mailviews.cache import LRUCache
+
+try:
+    from base64 import encodebytes
+except ImportError:  # Python 2
+    from base64 import encodestring as encodebytes
+
+
+#: The number of bytes read and encoded at a time. This is a multiple of 57,
+#: the number of bytes encoded on each 76 character line of base64, so that
+#: every chunk is encoded as whole lines.
+CHUNK_SIZE = 57 * 1024
+
+#: The MIME type used for attachments when one isn't provided and can't be
+#: guessed from the filename.
+DEFAULT_MIMETYPE = 'application/octet-stream'
+
+
+#: Encoded attachment content, keyed by a hash of the content. The size of
+#: this cache is the total number of encoded characters it holds.
+encoded_parts = LRUCache(max_size=32 * 1024 * 1024)
+
+#: The content hashes of attachment files, keyed by the path of the file and
+#: its inode, size and modification time, so that unchanged files don't need
+#: to be read to determine whether their encoded content is cached.
+file_digests = LRUCache(max_size=1000, sizeof=lambda digest: 1)
+
+
+def read_chunks(f, size=CHUNK_SIZE):
+    """
+    Yields the content of a file in chunks of (at most) ``size`` bytes,
+    reading from a memory map of the file where possible.
+    """
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # This isn't a regular file (or it is an empty one), so it can't be
+        # mapped and needs to be read instead.
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        try:
+            for offset in range(0, len(mapped), size):
+                yield mapped[offset:offset + size]
+        finally:
+            mapped.close()
+
+
+class FileAttachment(MIMEBase):
+    """
+    A base64 encoded attachment, read from a file path or a file-like object
+    each time the message it is attached to is serialized.
+
+    Unlike attachments provided to Django as ``(filename, content, mimetype)``
+    tuples, the content of the file isn't held by the message, and the same
+    instance can be attached to any number of messages. The file is read in
+    chunks, but the encoded content is built in memory when the message is
+    serialized (the email package requires the entire payload as a string),
+    so serializing a message needs memory for its encoded attachments.
+    File-like objects are read from the beginning every time they are
+    encoded, so they must be seekable if they are attached to more than one
+    message.
+
+    :param source: The path of the file, or a file-like object.
+    :param filename: The filename of the attachment. Defaults to the name of
+        the file.
+    :param mimetype: The MIME type of the attachment. Guessed from the
+        filename if not provided.
+    :param content_id: A content ID for the attachment, which allows it to
+        be referenced by the HTML body of the message (as ``cid:<content_id>``)
+        and displays it inline.
+    """
+    #: A cache used to store encoded content, keyed by a hash of the content.
+    #: This can be any Django cache instance or a
+    #: :class:`mailviews.cache.LRUCache`, or ``None`` to encode the content
+    #: every time it is serialized.
+    cache = encoded_parts
+
+    def __init__(self, source, filename=None, mimetype=None, content_id=None):
+        if filename is None:
+            name = source
+            if not isinstance(source, six.string_types):
+                name = getattr(source, 'name', None)
+            if isinstance(name, six.string_types):
+                filename = os.path.basename(name)
+
+        if mimetype is None and filename:
+            mimetype = mimetypes.guess_type(filename)[0]
+        mimetype = mimetype or DEFAULT_MIMETYPE
+
+        MIMEBase.__init__(self, *mimetype.split('/', 1))
+        self['Content-Transfer-Encoding'] = 'base64'
+        if filename:
+            try:
+                filename.encode('ascii')
+            except UnicodeEncodeError:
+                if six.PY2:
+                    filename = filename.encode('utf-8')
+                filename = ('utf-8', '', filename)
+
+        disposition = 'attachment' if content_id is None else 'inline'
+        if filename:
+            self.add_header('Content-Disposition', disposition,
+                filename=filename)
+        else:
+            self['Content-Disposition'] = disposition
+        if content_id is not None:
+            self['Content-ID'] = '<%s>' % content_id
+
+        #: The path of the file, or a file-like object.
+        self.source = source
+
+        # The payload is encoded as it is requested, but the email package
+        # expects the payload to be set.
+        self._payload = ''
+
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_FileAttachment__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def read(self):
+        """
+        Yields the content of the attachment in chunks.
+        """
+        if isinstance(self.source, six.string_types):
+            with open(self.source, 'rb') as f:
+                for chunk in read_chunks(f):
+                    yield chunk
+            return
+
+        # File-like objects may be shared between threads, so only allow
+        # one reader at a time.
+        with self.__lock:
+            if hasattr(self.source, 'seek'):
+                self.source.seek(0)
+            for chunk in read_chunks(self.source):
+                yield chunk
+
+    def digest(self):
+        """
+        Returns a hash of the content of the attachment.
+
+        The hashes of files are cached until the file is modified, while
+        file-like objects are read each time their hash is requested.
+        """
+        key = None
+        if isinstance(self.source, six.string_types):
+            stat = os.stat(self.source)
+            key = (os.path.abspath(self.source), stat.st_ino, stat.st_size,
+                stat.st_mtime)
+            digest = file_digests.get(key)
+            if digest is not None:
+                return digest
+
+        content_hash = hashlib.sha1()
+        for chunk in self.read():
+            content_hash.update(chunk)
+        digest = content_hash.hexdigest()
+
+        if key is not None:
+            file_digests.set(key, digest)
+        return digest
+
+    def encode(self):
+        """
+        Returns the content of the attachment, encoded as base64, from the
+        :attr:`cache` if the same content has been encoded before.
+        """
+        if self.cache is None:
+            return self.__encode()[1]
+
+        cached = self.cache.get('mailviews:attachment:%s' % self.digest())
+        if cached is not None:
+            return cached
+
+        # The content is hashed again while it is encoded, in case it has
+        # changed since the digest was computed.
+        digest, encoded = self.__encode()
+        self.cache.set('mailviews:attachment:%s' % digest, encoded)
+        return encoded
+
+    def __encode(self):
+        content_hash = hashlib.sha1()
+        pieces = []
+        for chunk in self.read():
+            content_hash.update(chunk)
+            pieces.append(force_str(encodebytes(chunk)))
+        encoded = ''.join(pieces)
+        if encoded.endswith('\n'):
+            encoded = encoded[:-1]
+        return content_hash.hexdigest(), encoded
+
+    def get_payload(self, i=None, decode=False):
+        if decode:
+            return b''.join(self.read())
+        return self.encode()
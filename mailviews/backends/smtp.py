@@ -0,0 +1,35 @@
+import smtplib
+
+from django.conf import settings
+from django.core.mail.backends import smtp
+from django.core.mail.message import sanitize_address
+
+from mailviews.messages import SerializedEmailMessage
+
+
+class EmailBackend(smtp.EmailBackend):
+    """
+    An SMTP email backend that sends the encoded content of
+    :class:`~mailviews.messages.SerializedEmailMessage` instances as-is,
+    rather than encoding each message again when it is sent. Other messages
+    are sent as they would be by Django's SMTP backend.
+    """
+    def _send(self, email_message):
+        if not isinstance(email_message, SerializedEmailMessage):
+            return super(EmailBackend, self)._send(email_message)
+
+        if not email_message.recipients():
+            return False
+
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(address, encoding)
+            for address in email_message.recipients()]
+        try:
+            self.connection.sendmail(from_email, recipients,
+                email_message.content)
+        except smtplib.SMTPException:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
@@ -0,0 +1,105 @@
+import threading
+from timeit import default_timer
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+def content_size(value):
+    """
+    Returns the approximate size of a value: the length of strings (or
+    bytes), summed over any nested lists, tuples or dictionary values. Other
+    values are counted as having a size of 1.
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(content_size(item) for item in value)
+    elif isinstance(value, dict):
+        return sum(content_size(item) for item in value.values())
+
+    try:
+        return len(value)
+    except TypeError:
+        return 1
+
+
+class LRUCache(object):
+    """
+    A thread-safe, in-process cache that evicts the least recently used
+    values once the total size of the values it contains exceeds a maximum.
+
+    Implements the subset of the Django cache API used by mailviews (``get``,
+    ``set``, ``delete`` and ``clear``), so it can be used anywhere a Django
+    cache is accepted when the values don't need to be shared between
+    processes.
+
+    :param max_size: The maximum total size of the cached values.
+    :param sizeof: A function that returns the size of a value. Defaults to
+        :func:`content_size`.
+    """
+    def __init__(self, max_size, sizeof=content_size):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.__entries = OrderedDict()  # key: (value, size, expires)
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                entry = self.__entries.pop(key)
+            except KeyError:
+                return default
+
+            value, size, expires = entry
+            if expires is not None and expires <= default_timer():
+                self.size -= size
+                return default
+
+            # Reinsert the entry, marking it as the most recently used.
+            self.__entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        """
+        Adds a value to the cache, evicting the least recently used values
+        if needed. Values larger than the maximum size are not cached.
+
+        :param timeout: The number of seconds the value should be cached for.
+            If not provided, the value does not expire.
+        """
+        size = self.sizeof(value)
+        expires = default_timer() + timeout if timeout is not None else None
+
+        with self.__lock:
+            self.__remove(key)
+            if size > self.max_size:
+                return
+
+            self.__entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                self.__remove(next(iter(self.__entries)))
+
+    def delete(self, key):
+        with self.__lock:
+            self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def __remove(self, key):
+        try:
+            value, size, expires = self.__entries.pop(key)
+        except KeyError:
+            return
+        self.size -= size
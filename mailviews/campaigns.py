@@ -0,0 +1,286 @@
+"""
+Resumable campaigns, for sending a message to a very large number of
+recipients from several worker processes (or machines) at once.
+
+The recipients of a campaign are partitioned into shards by a stable hash of
+each recipient's key, so every worker can iterate over the entire recipient
+set and only send the messages that belong to its own shard, without any
+coordination between workers. Each shard records the messages it has sent in
+a local checkpoint database, so a worker that is restarted after it stops
+(or crashes) skips the messages that it has already sent rather than
+sending the whole shard again.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+from timeit import default_timer
+
+from django.core.mail import get_connection
+from django.utils.encoding import force_bytes
+
+from mailviews.utils import timed, worker_pool
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    key TEXT PRIMARY KEY,
+    sent INTEGER NOT NULL,
+    error TEXT
+);
+"""
+
+
+def get_shard(key, shards):
+    """
+    Returns the shard (from ``0`` to ``shards - 1``) that a key belongs to.
+
+    Keys are hashed with SHA-1 rather than :func:`hash`, so that the shard
+    is the same in every process and on every machine.
+    """
+    return int(hashlib.sha1(force_bytes(key)).hexdigest()[:15], 16) % shards
+
+
+def get_recipient_key(item):
+    """
+    Returns the key of a campaign item: its (sorted) ``to`` addresses.
+    """
+    return ','.join(sorted(item['to']))
+
+
+class Checkpoint(object):
+    """
+    A record of the messages sent by a campaign shard, stored in a local
+    SQLite database.
+
+    Each message is recorded as soon as it has been sent, so a worker that
+    stops unexpectedly will send at most one message again when it is
+    restarted (the message it was sending when it stopped.)
+
+    :param path: The path of the database file, which is created if it
+        doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__connection = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.path)
+
+    def __connect(self):
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.path, timeout=30,
+                isolation_level=None)
+            # Write-ahead logging makes each commit durable if the process
+            # stops, without waiting for the disk after every message.
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.executescript(SCHEMA)
+        return self.__connection
+
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    def is_sent(self, key):
+        """
+        Returns whether the message with this key has been sent.
+        """
+        return self.__connect().execute('SELECT 1 FROM messages WHERE key = ? '
+            'AND sent = 1', (key,)).fetchone() is not None
+
+    def record(self, key, sent, error=None):
+        """
+        Records the result of sending the message with this key.
+        """
+        self.__connect().execute('INSERT OR REPLACE INTO messages (key, sent, '
+            'error) VALUES (?, ?, ?)', (key, int(bool(sent)), error))
+
+    def counts(self):
+        """
+        Returns a ``(sent, failed)`` tuple of the number of messages recorded.
+        """
+        rows = dict(self.__connect().execute('SELECT sent, COUNT(*) FROM '
+            'messages GROUP BY sent').fetchall())
+        return rows.get(1, 0), rows.get(0, 0)
+
+
+class CampaignReport(object):
+    """
+    The results of running a campaign shard.
+    """
+    def __init__(self, shard):
+        self.shard = shard
+
+        #: The number of messages sent.
+        self.sent = 0
+
+        #: The number of messages that could not be sent. These are retried
+        #: when the shard is run again.
+        self.failed = 0
+
+        #: The number of messages skipped, since they were sent by a previous
+        #: run of the shard.
+        self.skipped = 0
+
+        #: The number of seconds taken to run the shard.
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return '<%s: shard %s, %s sent, %s failed, %s skipped>' % (
+            type(self).__name__, self.shard, self.sent, self.failed,
+            self.skipped)
+
+    @property
+    def throughput(self):
+        """
+        The number of messages sent per second.
+        """
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+
+class Campaign(object):
+    """
+    Sends a message rendered by a message view to each item of a recipient
+    set, as one shard of a campaign.
+
+    Every shard of a campaign must be created with the same name, message
+    view, number of shards and key function, and run with the same items
+    (although the items don't need to be in the same order.)
+
+    :param name: The name of the campaign, used to name the checkpoint.
+    :param view: The message view used to render the messages.
+    :param shards: The number of shards the recipients are partitioned into.
+    :param shard: The shard sent by this instance, from ``0`` to
+        ``shards - 1``.
+    :param directory: The directory that the checkpoint is stored in.
+        Defaults to the current directory.
+    :param key: A function that returns the unique key of an item. Defaults
+        to :func:`get_recipient_key`.
+    """
+    def __init__(self, name, view, shards=1, shard=0, directory=None,
+            key=get_recipient_key):
+        if not 0 <= shard < shards:
+            raise ValueError('The shard must be between 0 and %s.' % (shards - 1))
+
+        self.name = name
+        self.view = view
+        self.shards = shards
+        self.shard = shard
+        self.directory = directory
+        self.key = key
+
+    def __repr__(self):
+        return '<%s: %s (shard %s of %s)>' % (type(self).__name__, self.name,
+            self.shard + 1, self.shards)
+
+    def get_checkpoint(self):
+        """
+        Returns the :class:`Checkpoint` for this shard. The number of shards
+        is included in its name, so checkpoints aren't reused if the
+        campaign is partitioned differently.
+        """
+        filename = '%s.%s-of-%s.sqlite3' % (self.name, self.shard, self.shards)
+        return Checkpoint(os.path.join(self.directory or '', filename))
+
+    def run(self, items, connection=None, **kwargs):
+        """
+        Renders and sends a message for each item in ``items`` that belongs
+        to this shard and hasn't already been sent.
+
+        Items have the same format as those accepted by
+        :meth:`~mailviews.messages.EmailMessageView.send_many`, and any
+        additional keyword arguments are used as defaults for every message.
+        Items are consumed lazily, so ``items`` may be an arbitrarily large
+        iterable.
+
+        :param connection: An email backend instance to use. If not provided,
+            a new connection will be created with
+            :func:`~django.core.mail.get_connection`.
+        :rtype: :class:`CampaignReport`
+        """
+        report = CampaignReport(self.shard)
+        start = default_timer()
+
+        if connection is None:
+            connection = get_connection()
+
+        checkpoint = self.get_checkpoint()
+        opened = connection.open()
+        try:
+            for item in items:
+                key = self.key(item)
+                if get_shard(key, self.shards) != self.shard:
+                    continue
+                elif checkpoint.is_sent(key):
+                    report.skipped += 1
+                    continue
+
+                failure = None
+                try:
+                    options = dict(kwargs, connection=connection)
+                    options.update(item)
+                    message = self.view.render_to_message(**options)
+                    with timed(self.view, 'send'):
+                        sent = connection.send_messages([message])
+                except Exception as error:
+                    sent = 0
+                    failure = '%s: %s' % (type(error).__name__, error)
+                    logger.exception('Could not send %r to %s.', self, key)
+
+                checkpoint.record(key, sent, failure)
+                if sent:
+                    report.sent += 1
+                else:
+                    report.failed += 1
+        finally:
+            checkpoint.close()
+            if opened:
+                connection.close()
+
+        report.elapsed = default_timer() - start
+        logger.info('Sent %s messages for %r in %.2f seconds (%s failed, %s '
+            'already sent.)', report.sent, self, report.elapsed,
+            report.failed, report.skipped)
+        return report
+
+
+# The campaign and items function used by worker processes started by
+# :func:`run_shards`.
+_worker_campaign = None
+
+
+def _initialize_worker(campaign, get_items, kwargs):
+    global _worker_campaign
+    _worker_campaign = (campaign, get_items, kwargs)
+
+
+def _run_shard(shard):
+    campaign, get_items, kwargs = _worker_campaign
+    campaign = Campaign(campaign.name, campaign.view, campaign.shards, shard,
+        campaign.directory, campaign.key)
+    return campaign.run(get_items(), **kwargs)
+
+
+def run_shards(campaign, get_items, processes=None, **kwargs):
+    """
+    Runs every shard of a campaign on the local machine, using a pool of
+    worker processes (one for each shard at a time.)
+
+    :param campaign: Any shard of the campaign, providing its name, message
+        view and number of shards.
+    :param get_items: A function that returns the items of the campaign. It
+        is called once in each worker process.
+    :param processes: The number of worker processes to use. Defaults to the
+        number of CPUs available.
+    :returns: A list of the :class:`CampaignReport` for each shard.
+    """
+    campaign.view.base_context
+
+    initargs = (campaign, get_items, kwargs)
+    with worker_pool(processes, _initialize_worker, initargs) as pool:
+        return pool.map(_run_shard, range(campaign.shards))
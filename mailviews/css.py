@@ -0,0 +1,429 @@
+"""
+Inlines CSS from ``<style>`` elements into the ``style`` attributes of the
+elements of an HTML document, since many email clients ignore stylesheets.
+
+Stylesheets are parsed and their selectors are compiled into a
+:class:`Stylesheet` the first time they are seen. Compiled stylesheets are
+cached, so documents rendered from the same template (which will typically
+contain the same stylesheet) only pay the cost of applying the rules.
+
+Only type (``p``), universal (``*``), class (``.title``) and ID (``#header``)
+selectors (and compounds of them) are supported, combined with the descendant
+(``div p``) and child (``div > p``) combinators. Rules that can't be inlined
+(such as those using pseudo-classes, or within ``@media`` blocks) are left in
+the document's stylesheet.
+"""
+import re
+from itertools import count
+
+from mailviews.cache import LRUCache
+
+
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+
+COMPOUND_RE = re.compile(r'^(\*|[a-zA-Z][\w-]*)?((?:[#.][\w-]+)*)$')
+
+# Comments are matched so that any style elements within them (such as those
+# in conditional comments for Outlook) are skipped.
+STYLE_RE = re.compile(r'<!--.*?-->|<style\b([^>]*)>(.*?)</style\s*>',
+    re.S | re.I)
+
+TAG_RE = re.compile(r'<!--.*?-->|<(/?)([a-zA-Z][\w:-]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>', re.S)
+
+ATTRIBUTE_RE = re.compile(r'([^\s/>"\'=]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]+))?')
+
+VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr',
+))
+
+#: The specificity given to declarations in ``style`` attributes, which
+#: take precedence over any declarations from a stylesheet (unless they are
+#: marked as important.)
+INLINE_SPECIFICITY = (1, 0, 0, 0)
+
+
+class UnsupportedSelector(ValueError):
+    pass
+
+
+class UnsupportedDeclaration(ValueError):
+    pass
+
+
+def parse_blocks(css):
+    """
+    Splits a stylesheet into its top-level statements, returning a list of
+    ``(prelude, body)`` tuples. The body is ``None`` for at-rules that do
+    not have a block, such as ``@import``.
+    """
+    css = COMMENT_RE.sub('', css)
+    blocks = []
+    position = 0
+    while True:
+        start = css.find('{', position)
+        semicolon = css.find(';', position)
+        if semicolon != -1 and (start == -1 or semicolon < start):
+            prelude = css[position:semicolon].strip()
+            if prelude:
+                blocks.append((prelude, None))
+            position = semicolon + 1
+            continue
+
+        if start == -1:
+            break
+
+        depth = 1
+        end = start + 1
+        while depth and end < len(css):
+            if css[end] == '{':
+                depth += 1
+            elif css[end] == '}':
+                depth -= 1
+            end += 1
+
+        blocks.append((css[position:start].strip(), css[start + 1:end - 1]))
+        position = end
+    return blocks
+
+
+def split_declarations(body):
+    """
+    Splits a rule body or ``style`` attribute on its top-level semicolons,
+    ignoring those within quoted strings or parentheses (such as in
+    ``url(data:image/png;base64,...)``.)
+
+    :raises UnsupportedDeclaration: if a string or parenthesised group is
+        not closed.
+    """
+    pieces = []
+    start = depth = position = 0
+    quote = None
+    while position < len(body):
+        char = body[position]
+        if char == '\\':
+            position += 1  # Skip the escaped character.
+        elif quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            if not depth:
+                raise UnsupportedDeclaration(body)
+            depth -= 1
+        elif char == ';' and not depth:
+            pieces.append(body[start:position])
+            start = position + 1
+        position += 1
+
+    if quote is not None or depth:
+        raise UnsupportedDeclaration(body)
+    pieces.append(body[start:])
+    return pieces
+
+
+def parse_declarations(body):
+    """
+    Returns a list of ``(property, value, important)`` tuples for the
+    declarations in a rule body or ``style`` attribute.
+
+    :raises UnsupportedDeclaration: if the declarations can't be split
+        safely.
+    """
+    declarations = []
+    for declaration in split_declarations(body):
+        name, sep, value = declaration.partition(':')
+        name, value = name.strip().lower(), value.strip()
+        if not sep or not name or not value:
+            continue
+
+        important = value.lower().endswith('!important')
+        declarations.append((name, value, important))
+    return declarations
+
+
+class Element(object):
+    __slots__ = ('tag', 'id', 'classes')
+
+    def __init__(self, tag, id, classes):
+        self.tag = tag
+        self.id = id
+        self.classes = classes
+
+
+class Compound(object):
+    """
+    A sequence of simple selectors that all apply to the same element.
+    """
+    def __init__(self, value):
+        match = COMPOUND_RE.match(value)
+        if not value or match is None:
+            raise UnsupportedSelector(value)
+
+        tag, rest = match.groups()
+        parts = re.findall(r'[#.][\w-]+', rest)
+        ids = set(part[1:] for part in parts if part[0] == '#')
+        if len(ids) > 1:
+            raise UnsupportedSelector(value)  # This could never match.
+
+        self.tag = tag.lower() if tag and tag != '*' else None
+        self.id = ids.pop() if ids else None
+        self.classes = frozenset(part[1:] for part in parts if part[0] == '.')
+
+    @property
+    def specificity(self):
+        return (int(self.id is not None), len(self.classes),
+            int(self.tag is not None))
+
+    def matches(self, element):
+        return ((self.tag is None or self.tag == element.tag) and
+            (self.id is None or self.id == element.id) and
+            self.classes <= element.classes)
+
+
+class Selector(object):
+    """
+    A compiled selector, consisting of compounds joined by combinators.
+    """
+    def __init__(self, value):
+        parts = re.sub(r'\s*>\s*', ' > ', value.strip()).split()
+        self.compounds = []
+        self.combinators = []  # The combinator preceding each compound.
+        combinator = None
+        for part in parts:
+            if part == '>':
+                if combinator is not None or not self.compounds:
+                    raise UnsupportedSelector(value)
+                combinator = '>'
+                continue
+            self.compounds.append(Compound(part))
+            self.combinators.append(combinator or ' ')
+            combinator = None
+
+        if not self.compounds or combinator is not None:
+            raise UnsupportedSelector(value)
+
+        # The leading zero ensures that selectors are always less specific
+        # than declarations in ``style`` attributes.
+        self.specificity = (0,) + tuple(map(sum, zip(*(compound.specificity
+            for compound in self.compounds))))
+
+    @property
+    def key(self):
+        """
+        The most specific simple selector in the last compound, used to index
+        rules so that only rules that could match an element are checked.
+        """
+        subject = self.compounds[-1]
+        if subject.id is not None:
+            return ('id', subject.id)
+        elif subject.classes:
+            return ('class', min(subject.classes))
+        elif subject.tag is not None:
+            return ('tag', subject.tag)
+        return None
+
+    def matches(self, element, ancestors):
+        last = len(self.compounds) - 1
+        return (self.compounds[last].matches(element) and
+            self.__matches_ancestors(last, ancestors, len(ancestors)))
+
+    def __matches_ancestors(self, index, ancestors, end):
+        if index == 0:
+            return True
+
+        compound = self.compounds[index - 1]
+        if self.combinators[index] == '>':
+            return (end > 0 and compound.matches(ancestors[end - 1]) and
+                self.__matches_ancestors(index - 1, ancestors, end - 1))
+
+        for position in range(end - 1, -1, -1):
+            if (compound.matches(ancestors[position]) and
+                    self.__matches_ancestors(index - 1, ancestors, position)):
+                return True
+        return False
+
+
+class Stylesheet(object):
+    """
+    A compiled stylesheet that can be applied to many documents.
+    """
+    def __init__(self, css):
+        #: The rules that can't be inlined, as CSS source.
+        self.remainder = []
+
+        self.rules = []
+        self.index = {}
+        self.universal = []
+
+        order = count()
+        for prelude, body in parse_blocks(css):
+            if body is None:
+                self.remainder.append('%s;' % prelude)
+                continue
+            elif prelude.startswith('@'):
+                self.remainder.append('%s {%s}' % (prelude, body))
+                continue
+
+            try:
+                declarations = parse_declarations(body)
+            except UnsupportedDeclaration:
+                # Leave the rule as it is, rather than inlining broken CSS.
+                self.remainder.append('%s {%s}' % (prelude, body))
+                continue
+
+            unsupported = []
+            for value in prelude.split(','):
+                try:
+                    selector = Selector(value)
+                except UnsupportedSelector:
+                    unsupported.append(value.strip())
+                    continue
+
+                rule = (selector, declarations, next(order))
+                self.rules.append(rule)
+                if selector.key is None:
+                    self.universal.append(rule)
+                else:
+                    self.index.setdefault(selector.key, []).append(rule)
+
+            if unsupported:
+                self.remainder.append('%s {%s}' % (', '.join(unsupported), body))
+
+    def get_candidate_rules(self, element):
+        rules = list(self.universal)
+        if element.id is not None:
+            rules.extend(self.index.get(('id', element.id), ()))
+        for name in element.classes:
+            rules.extend(self.index.get(('class', name), ()))
+        rules.extend(self.index.get(('tag', element.tag), ()))
+        return rules
+
+    def get_style(self, element, ancestors, inline):
+        """
+        Returns the value of the ``style`` attribute for the element, given
+        its current ``style`` attribute (or ``None``.)
+        """
+        declarations = []
+        for selector, rule_declarations, order in self.get_candidate_rules(element):
+            if selector.matches(element, ancestors):
+                for name, value, important in rule_declarations:
+                    declarations.append(((important, selector.specificity, order), name, value))
+
+        if not declarations:
+            return inline
+
+        if inline:
+            try:
+                inline_declarations = parse_declarations(inline)
+            except UnsupportedDeclaration:
+                return inline  # Leave the element's style as it is.
+            for order, (name, value, important) in enumerate(inline_declarations):
+                declarations.append(((important, INLINE_SPECIFICITY, order), name, value))
+
+        values = {}
+        names = []
+        for _, name, value in sorted(declarations, key=lambda item: item[0]):
+            if name not in values:
+                names.append(name)
+            values[name] = value
+        return '; '.join('%s: %s' % (name, values[name]) for name in names)
+
+    def apply(self, html):
+        """
+        Returns the HTML document with the rules of this stylesheet inlined.
+        """
+        ancestors = []
+
+        def replace(match):
+            closing, tag, attributes = match.groups()
+            if tag is None:
+                return match.group(0)  # A comment.
+
+            tag = tag.lower()
+            if closing:
+                for position in range(len(ancestors) - 1, -1, -1):
+                    if ancestors[position].tag == tag:
+                        del ancestors[position:]
+                        break
+                return match.group(0)
+
+            values = {}
+            for name, value in ATTRIBUTE_RE.findall(attributes.rstrip('/')):
+                if value[:1] in ('"', "'"):
+                    value = value[1:-1]
+                values.setdefault(name.lower(), value)
+
+            element = Element(tag, values.get('id'),
+                frozenset(values.get('class', '').split()))
+            inline = values.get('style')
+            style = self.get_style(element, ancestors, inline)
+
+            if tag not in VOID_ELEMENTS and not attributes.rstrip().endswith('/'):
+                ancestors.append(element)
+
+            if style == inline:
+                return match.group(0)
+
+            if inline is not None:
+                attributes = ATTRIBUTE_RE.sub(lambda attribute:
+                    '' if attribute.group(1).lower() == 'style' else attribute.group(0),
+                    attributes)
+            attributes, slash = attributes.rstrip(), ''
+            if attributes.endswith('/'):
+                attributes, slash = attributes[:-1].rstrip(), ' /'
+            return '<%s%s style="%s"%s>' % (match.group(2), attributes,
+                style.replace('"', '&quot;'), slash)
+
+        return TAG_RE.sub(replace, html)
+
+
+#: Compiled stylesheets, keyed by their source.
+stylesheets = LRUCache(max_size=100, sizeof=lambda stylesheet: 1)
+
+
+def get_stylesheet(css):
+    """
+    Returns a compiled :class:`Stylesheet` for the CSS source, from the
+    cache if it has been compiled before.
+    """
+    stylesheet = stylesheets.get(css)
+    if stylesheet is None:
+        stylesheet = Stylesheet(css)
+        stylesheets.set(css, stylesheet)
+    return stylesheet
+
+
+def inline_css(html):
+    """
+    Inlines the rules from all of the ``<style>`` elements in an HTML
+    document into the ``style`` attributes of the elements they apply to.
+
+    Style elements with a ``media`` attribute, and those within comments
+    (such as ``<!--[if mso]>`` conditional comments, which only apply to
+    some clients), are left untouched. The first of the other style elements
+    is replaced with a style element that only contains the rules that
+    couldn't be inlined (if there are any), and the rest are removed.
+    """
+    blocks = [match for match in STYLE_RE.finditer(html)
+        if match.group(1) is not None
+        and 'media' not in match.group(1).lower()]
+    if not blocks:
+        return html
+
+    stylesheet = get_stylesheet('\n'.join(match.group(2) for match in blocks))
+
+    pieces = []
+    position = 0
+    for match in blocks:
+        pieces.append(html[position:match.start()])
+        if match is blocks[0] and stylesheet.remainder:
+            pieces.append('<style%s>\n%s\n</style>' % (match.group(1),
+                '\n'.join(stylesheet.remainder)))
+        position = match.end()
+    pieces.append(html[position:])
+
+    return stylesheet.apply(''.join(pieces))
@@ -0,0 +1,103 @@
+import errno
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_bytes
+
+from mailviews.messages import serialize_message
+from mailviews.previews import autodiscover, get_html_alternative, site
+from mailviews.utils import worker_pool
+
+
+def export_preview(directory, module, name):
+    """
+    Renders a registered preview, writing its HTML body (if it has one),
+    plain text body and raw message to files within the directory.
+
+    Returns a ``(module, name, paths, error)`` tuple.
+    """
+    try:
+        message = site.get_preview(module, name).render_sample_message()
+        parts = {
+            'html': get_html_alternative(message),
+            'txt': message.body,
+            'eml': serialize_message(message),
+        }
+
+        path = os.path.join(directory, module)
+        try:
+            os.makedirs(path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+        paths = []
+        for extension, content in sorted(parts.items()):
+            if content is None:
+                continue
+            paths.append(os.path.join(path, '%s.%s' % (name, extension)))
+            with open(paths[-1], 'wb') as f:
+                f.write(force_bytes(content))
+    except Exception as error:
+        return module, name, [], '%s: %s' % (type(error).__name__, error)
+
+    return module, name, paths, None
+
+
+# The directory that previews are written to by worker processes.
+_worker_directory = None
+
+
+def _initialize_worker(directory):
+    global _worker_directory
+    _worker_directory = directory
+
+
+def _export_preview(key):
+    return export_preview(_worker_directory, *key)
+
+
+class Command(BaseCommand):
+    help = ('Renders all registered message previews, writing their HTML '
+        'body, plain text body and raw message to a directory.')
+    args = '<directory>'
+
+    if not hasattr(BaseCommand, 'add_arguments'):  # Django < 1.8
+        option_list = BaseCommand.option_list + (
+            make_option('--processes', type='int', default=None,
+                help='the number of worker processes to use (default: the '
+                    'number of CPUs available)'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory',
+            help='the directory to write the rendered previews to')
+        parser.add_argument('--processes', type=int, default=None,
+            help='the number of worker processes to use (default: the '
+                'number of CPUs available)')
+
+    def handle(self, directory=None, processes=None, **options):
+        if directory is None:
+            raise CommandError('A directory to write the previews to must be '
+                'provided.')
+
+        autodiscover()
+
+        keys = [(previews.module, type(preview).__name__)
+            for previews in site for preview in previews.previews]
+
+        failures = 0
+        with worker_pool(processes, _initialize_worker, (directory,)) as pool:
+            results = pool.imap_unordered(_export_preview, keys)
+            for module, name, paths, error in results:
+                if error is None:
+                    for path in paths:
+                        self.stdout.write(path)
+                else:
+                    failures += 1
+                    self.stderr.write('%s.%s: %s' % (module, name, error))
+
+        if failures:
+            raise CommandError('%s of %s previews could not be exported.' %
+                (failures, len(keys)))
@@ -0,0 +1,78 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from mailviews.outbox import get_outbox
+from mailviews.utils import worker_pool
+
+
+def drain_outbox(path, batch_size, interval=None):
+    """
+    Sends the messages in the outbox until it is empty, or indefinitely
+    (checking for new messages every ``interval`` seconds) if an interval is
+    provided.
+
+    Returns a ``(sent, failed)`` tuple.
+    """
+    outbox = get_outbox(path)
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = outbox.drain(batch_size)
+        total_sent += sent
+        total_failed += failed
+        if interval is None:
+            return total_sent, total_failed
+        time.sleep(interval)
+
+
+def _drain_outbox(args):
+    return drain_outbox(*args)
+
+
+class Command(BaseCommand):
+    help = ('Renders and sends the messages in the outbox (see the '
+        'EmailMessageView.send_later method.)')
+
+    if not hasattr(BaseCommand, 'add_arguments'):  # Django < 1.8
+        option_list = BaseCommand.option_list + (
+            make_option('--outbox', default=None,
+                help='the path of the outbox (default: the MAILVIEWS_OUTBOX '
+                    'setting)'),
+            make_option('--processes', type='int', default=1,
+                help='the number of worker processes to use (default: '
+                    '%default)'),
+            make_option('--batch-size', type='int', default=100,
+                help='the number of messages sent through each email '
+                    'backend connection (default: %default)'),
+            make_option('--interval', type='float', default=None,
+                help='keep running, checking for new messages at this '
+                    'interval (in seconds) once the outbox is empty'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--outbox', default=None,
+            help='the path of the outbox (default: the MAILVIEWS_OUTBOX '
+                'setting)')
+        parser.add_argument('--processes', type=int, default=1,
+            help='the number of worker processes to use (default: '
+                '%(default)s)')
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='the number of messages sent through each email backend '
+                'connection (default: %(default)s)')
+        parser.add_argument('--interval', type=float, default=None,
+            help='keep running, checking for new messages at this interval '
+                '(in seconds) once the outbox is empty')
+
+    def handle(self, outbox=None, processes=1, batch_size=100, interval=None,
+            **options):
+        args = (get_outbox(outbox).path, batch_size, interval)
+
+        if processes == 1:
+            sent, failed = drain_outbox(*args)
+        else:
+            with worker_pool(processes) as pool:
+                results = pool.map(_drain_outbox, [args] * processes)
+            sent, failed = [sum(values) for values in zip(*results)]
+
+        self.stdout.write('Sent %s messages (%s failed.)' % (sent, failed))
@@ -1,9 +1,146 @@
+import email
+import hashlib
+import logging
+import re
+from email.mime.base import MIMEBase
+
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection
 from django.core.mail.message import EmailMessage, EmailMultiAlternatives
 from django.template import Context
 from django.template.loader import get_template, select_template
+from django.utils import six
+from django.utils.encoding import force_bytes
+
+from mailviews.attachments import FileAttachment
+from mailviews.css import inline_css
+from mailviews.outbox import get_outbox
+from mailviews.utils import (fingerprint, timed, unescape,
+    unescaped_template, worker_pool)
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+
+logger = logging.getLogger(__name__)
 
-from mailviews.utils import unescape
+# Matches every line ending, so that they can all be converted to CRLF.
+LINE_ENDING_RE = re.compile(br'\r\n|\r(?!\n)|\n')
+
+
+#: Settings that affect how template names are resolved. When any of these
+#: are changed, the resolved template cache is invalidated.
+TEMPLATE_SETTINGS = frozenset((
+    'TEMPLATES',
+    'TEMPLATE_DIRS',
+    'TEMPLATE_LOADERS',
+    'INSTALLED_APPS',
+))
+
+#: Message priorities, used by :class:`mailviews.scheduler.PriorityScheduler`
+#: to send transactional messages (such as password resets and receipts)
+#: ahead of bulk messages (such as newsletters.) Lower values are sent first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+
+class RenderedMessage(object):
+    """
+    The rendered content of a message, prior to being assembled into a
+    message instance by :meth:`EmailMessageView.build_message`.
+    """
+    def __init__(self, subject, body, alternatives=None, headers=None):
+        #: The rendered subject.
+        self.subject = subject
+
+        #: The rendered plain text body.
+        self.body = body
+
+        #: A list of ``(content, mimetype)`` tuples for any alternative
+        #: representations of the body (such as ``text/html``.)
+        self.alternatives = list(alternatives or ())
+
+        #: A dictionary of headers to add to the message.
+        self.headers = dict(headers or {})
+
+    def __repr__(self):
+        return '<%s: %r>' % (type(self).__name__, self.subject)
+
+
+def serialize_message(message):
+    """
+    Returns the encoded MIME message for a message instance, as bytes with
+    CRLF line endings (as required by SMTP.)
+
+    The email package generates messages with bare LF line endings, which
+    :mod:`smtplib` only converts when messages are sent as text, rather than
+    bytes.
+    """
+    mime = message.message()
+    as_bytes = getattr(mime, 'as_bytes', mime.as_string)  # Python 2
+    return LINE_ENDING_RE.sub(b'\r\n', force_bytes(as_bytes()))
+
+
+class SerializedEmailMessage(object):
+    """
+    A message that has been encoded once, along with the envelope needed to
+    send it. The same encoded content can be previewed, stored and sent
+    without encoding the message again.
+
+    Sending with :class:`mailviews.backends.smtp.EmailBackend` passes the
+    encoded content directly to the SMTP server. Other email backends can
+    also send these messages, although they may decode and re-encode them.
+
+    :param message: The message instance to encode.
+    :type message: :class:`~django.core.mail.EmailMessage`
+    """
+    def __init__(self, message):
+        self.subject = message.subject
+        self.from_email = message.from_email
+        self.to = list(message.to)
+        self.cc = list(message.cc)
+        self.bcc = list(message.bcc)
+        self.encoding = message.encoding
+        self.connection = message.connection
+
+        #: The encoded MIME message, with CRLF line endings.
+        self.content = serialize_message(message)
+
+    def __repr__(self):
+        return '<%s: %r>' % (type(self).__name__, self.subject)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None  # Connections can't be pickled.
+        return state
+
+    def recipients(self):
+        """
+        Returns a list of all recipients of the message (including ``cc``
+        and ``bcc`` recipients.)
+        """
+        return self.to + self.cc + self.bcc
+
+    def message(self):
+        """
+        Returns the message parsed from its encoded content, for email
+        backends that require a :class:`email.message.Message` instance.
+        """
+        if six.PY3:
+            return email.message_from_bytes(self.content)
+        return email.message_from_string(self.content)
+
+    def send(self, fail_silently=False):
+        if not self.recipients():
+            return 0
+        connection = self.connection
+        if connection is None:
+            connection = get_connection(fail_silently=fail_silently)
+        return connection.send_messages([self])
 
 
 class EmailMessageView(object):
@@ -13,6 +150,36 @@ class EmailMessageView(object):
     """
     message_class = EmailMessage
 
+    #: A cache used to store rendered message content, allowing messages with
+    #: identical contexts to be rendered only once. This can be any Django
+    #: cache instance (such as ``django.core.cache.caches['default']``) or a
+    #: :class:`mailviews.cache.LRUCache`. Caching is disabled by default,
+    #: since rendering may depend on more than the context data (such as the
+    #: current time.)
+    render_cache = None
+
+    #: The number of seconds that rendered message content should be cached
+    #: for. If not provided, the default timeout of the cache is used.
+    render_cache_timeout = None
+
+    #: Files to attach to every message rendered by this view. Each item can
+    #: be a file path, a file-like object, or a MIME part (such as a
+    #: :class:`~mailviews.attachments.FileAttachment`.) Files are read and
+    #: encoded as each message is serialized, rather than being read into
+    #: memory when the message is rendered.
+    attachments = ()
+
+    #: The priority of messages rendered by this view, when they are sent by a
+    #: :class:`mailviews.scheduler.PriorityScheduler`. One of
+    #: :data:`PRIORITY_HIGH`, :data:`PRIORITY_NORMAL` or :data:`PRIORITY_BULK`
+    #: (or any other number, where lower values are sent first.)
+    priority = PRIORITY_NORMAL
+
+    #: A :class:`mailviews.pool.ConnectionPool` that messages are sent
+    #: through by :meth:`send` and :meth:`send_many`, unless a connection is
+    #: provided. If not set, a new connection is created for each call.
+    connection_pool = None
+
     @property
     def headers(self):
         """
@@ -28,13 +195,161 @@ class EmailMessageView(object):
     def render_body(self, context):
         raise NotImplementedError  # Must be implemented by subclasses.
 
+    def get_base_context_data(self):
+        """
+        Returns the context data that is shared between all of the messages
+        rendered by this view instance, such as content that is the same for
+        every recipient of a campaign.
+
+        This is only called once for each view instance, the first time that
+        a message is rendered. The returned dictionary should not be modified
+        after it has been returned.
+
+        :rtype: :class:`dict`
+        """
+        return {}
+
+    @property
+    def base_context(self):
+        """
+        The (cached) result of :meth:`get_base_context_data`.
+        """
+        if not hasattr(self, '_base_context'):
+            self._base_context = self.get_base_context_data()
+        return self._base_context
+
     def get_context_data(self, **kwargs):
         """
         Returns the context that will be used for rendering this message.
 
+        The context is layered on top of the :attr:`base_context` rather than
+        copying it, so only the per-message data needs to be built for each
+        message.
+
         :rtype: :class:`django.template.Context`
         """
-        return Context(kwargs)
+        context = Context(self.base_context)
+        # Always push a new layer (even if it's empty), so that any values
+        # added to the context are never written to the shared base context.
+        context.update(kwargs)
+        return context
+
+    def render_parts(self, context):
+        """
+        Renders the individual parts of a message for the given context.
+
+        This is called at most once per message with the context returned by
+        :meth:`get_context_data` (and not at all if the message content is
+        retrieved from the :attr:`render_cache`), and the same context is
+        shared between all of the rendered parts. Subclasses that need to add
+        or alter content should extend this method and modify the returned
+        result.
+
+        :param context: The context to use when rendering the message.
+        :type context: :class:`~django.template.Context`
+        :rtype: :class:`RenderedMessage`
+        """
+        with timed(self, 'subject'):
+            subject = self.render_subject(context)
+
+        with timed(self, 'body'):
+            body = self.render_body(context)
+
+        return RenderedMessage(subject=subject, body=body, headers=self.headers)
+
+    def get_render_cache_key(self, context):
+        """
+        Returns the key used to store the content rendered for the given
+        context in the :attr:`render_cache`, or ``None`` if the rendered
+        content should not be cached.
+
+        By default, the key is built from the message view class and a
+        fingerprint of all of the context data. The shared
+        :attr:`base_context` is only fingerprinted once for each view
+        instance, so only the per-message data is serialized for each
+        message. Subclasses may override this to provide a cheaper
+        fingerprint, for instance if the rendered content only varies by the
+        recipient's locale.
+
+        :param context: The context that will be used to render the message.
+        :type context: :class:`~django.template.Context`
+        :rtype: :class:`str`
+        """
+        if not hasattr(self, '_base_context_fingerprint'):
+            self._base_context_fingerprint = fingerprint(
+                Context(self.base_context))
+
+        base_digest = self._base_context_fingerprint
+        digest = fingerprint(context, exclude=(self.base_context,))
+        if base_digest is None or digest is None:
+            return None
+
+        digest = hashlib.sha1(force_bytes(base_digest + digest)).hexdigest()
+        cls = type(self)
+        return 'mailviews:%s.%s:%s' % (cls.__module__, cls.__name__, digest)
+
+    def render_cached_parts(self, context):
+        """
+        Returns the rendered parts for the given context, from the
+        :attr:`render_cache` when possible. Headers are never cached, and are
+        always the current :attr:`headers` of this message view.
+
+        :param context: The context to use when rendering the message.
+        :type context: :class:`~django.template.Context`
+        :rtype: :class:`RenderedMessage`
+        """
+        if self.render_cache is None:
+            return self.render_parts(context)
+
+        key = self.get_render_cache_key(context)
+        if key is None:
+            return self.render_parts(context)
+
+        cached = self.render_cache.get(key)
+        if cached is not None:
+            subject, body, alternatives = cached
+            return RenderedMessage(subject, body, alternatives, self.headers)
+
+        parts = self.render_parts(context)
+        value = (parts.subject, parts.body, parts.alternatives)
+        if self.render_cache_timeout is None:
+            self.render_cache.set(key, value)
+        else:
+            self.render_cache.set(key, value, self.render_cache_timeout)
+        return parts
+
+    def get_attachments(self):
+        """
+        Returns the MIME parts for the :attr:`attachments` of this view.
+
+        :rtype: :class:`list`
+        """
+        return [attachment if isinstance(attachment, MIMEBase)
+            else FileAttachment(attachment) for attachment in self.attachments]
+
+    def build_message(self, parts, **kwargs):
+        """
+        Constructs an unsent message instance from previously rendered parts.
+
+        :param parts: The rendered message content.
+        :type parts: :class:`RenderedMessage`
+        :returns: A message instance.
+        :rtype: :attr:`.message_class`
+        """
+        # Ensure our custom headers are added to the underlying message class.
+        kwargs.setdefault('headers', {}).update(parts.headers)
+
+        attachments = self.get_attachments()
+        if attachments:
+            kwargs['attachments'] = attachments + list(kwargs.get('attachments') or ())
+
+        message = self.message_class(
+            subject=parts.subject,
+            body=parts.body,
+            **kwargs)
+        for content, mimetype in parts.alternatives:
+            message.attach_alternative(content, mimetype)
+        return message
 
     def render_to_message(self, extra_context=None, **kwargs):
         """
@@ -52,14 +367,98 @@ class EmailMessageView(object):
         if extra_context is None:
             extra_context = {}
 
-        # Ensure our custom headers are added to the underlying message class.
-        kwargs.setdefault('headers', {}).update(self.headers)
+        with timed(self, 'context'):
+            context = self.get_context_data(**extra_context)
 
-        context = self.get_context_data(**extra_context)
-        return self.message_class(
-            subject=self.render_subject(context),
-            body=self.render_body(context),
-            **kwargs)
+        parts = self.render_cached_parts(context)
+
+        with timed(self, 'message'):
+            return self.build_message(parts, **kwargs)
+
+    def render_to_serialized_message(self, extra_context=None, **kwargs):
+        """
+        Renders a message with the provided context (as
+        :meth:`render_to_message` does), returning it encoded as a
+        :class:`SerializedEmailMessage` which can be sent with an email
+        backend, or previewed, without encoding it again.
+
+        :rtype: :class:`SerializedEmailMessage`
+        """
+        message = self.render_to_message(extra_context=extra_context, **kwargs)
+        with timed(self, 'serialize'):
+            return SerializedEmailMessage(message)
+
+    def render_to_bytes(self, extra_context=None, **kwargs):
+        """
+        Renders a message with the provided context, returning the encoded
+        MIME message.
+
+        :rtype: :class:`bytes`
+        """
+        return self.render_to_serialized_message(extra_context=extra_context,
+            **kwargs).content
+
+    def iter_messages(self, items, **kwargs):
+        """
+        Returns a generator that lazily renders a message for each item in
+        ``items``, yielding them one at a time.
+
+        Items have the same format as those accepted by :meth:`send_many`,
+        and any additional keyword arguments are used as defaults for every
+        message. Since only one item is consumed (and one message is rendered)
+        at a time, this can be used with arbitrarily large iterables, such as
+        a queryset iterator::
+
+            messages = view.iter_messages(
+                {'extra_context': {'user': user}, 'to': (user.email,)}
+                for user in User.objects.iterator())
+
+        :param items: An iterable of per-message keyword argument dictionaries.
+        :returns: A generator of message instances.
+        """
+        for item in items:
+            options = kwargs.copy()
+            options.update(item)
+            yield self.render_to_message(**options)
+
+    def render_many(self, items, workers=None, chunksize=1, **kwargs):
+        """
+        Renders a message for each item in ``items``, distributing the
+        rendering of message content across a pool of worker processes.
+
+        Items have the same format as those accepted by :meth:`send_many`.
+        Only the ``extra_context`` of each item is sent to the worker
+        processes, which return the :class:`RenderedMessage` produced by
+        :meth:`render_cached_parts`. The message instances are then assembled
+        in the calling process with :meth:`build_message`.
+
+        The message view itself is provided to the worker processes when they
+        are started. On platforms where new processes are not created by
+        forking, this requires that the message view can be pickled. The
+        rendered parts (and therefore any headers) must always be picklable.
+
+        :param items: An iterable of per-message keyword argument dictionaries.
+        :param workers: The number of worker processes to use. Defaults to the
+            number of CPUs available.
+        :param chunksize: The number of items sent to a worker at a time.
+        :returns: A list of message instances, in the same order as ``items``.
+        :rtype: :class:`list`
+        """
+        items = [dict(kwargs, **item) for item in items]
+
+        # Build the shared context before forking, so that it is only built
+        # once rather than once in each of the worker processes.
+        self.base_context
+
+        with worker_pool(workers, _initialize_render_worker, (self,)) as pool:
+            contexts = [item.pop('extra_context', None) for item in items]
+            rendered = pool.imap(_render_parts, contexts, chunksize)
+            messages = []
+            for parts, item in zip(rendered, items):
+                with timed(self, 'message'):
+                    messages.append(self.build_message(parts, **item))
+
+        return messages
 
     def send(self, extra_context=None, **kwargs):
         """
@@ -79,8 +478,96 @@ class EmailMessageView(object):
             when rendering this message.
         :type extra_context: :class:`dict`
         """
+        if self.connection_pool is not None:
+            kwargs.setdefault('connection', self.connection_pool)
+
         message = self.render_to_message(extra_context=extra_context, **kwargs)
-        return message.send()
+        with timed(self, 'send'):
+            return message.send()
+
+    def send_later(self, extra_context=None, outbox=None, **kwargs):
+        """
+        Adds a message to the outbox, to be rendered and sent later by the
+        ``mailviews_outbox`` management command (see :mod:`mailviews.outbox`.)
+
+        This message view instance is stored along with the context data and
+        keyword arguments, all of which must be picklable. (The message view
+        class must also be importable by the worker processes.)
+
+        :param extra_context: Any additional context data that will be used
+            when rendering this message.
+        :type extra_context: :class:`dict`
+        :param outbox: The outbox to add the message to. Defaults to the
+            outbox configured by the ``MAILVIEWS_OUTBOX`` setting.
+        :type outbox: :class:`~mailviews.outbox.Outbox`
+        :returns: The ID of the message in the outbox.
+        """
+        if outbox is None:
+            outbox = get_outbox()
+        return outbox.put(self, extra_context, **kwargs)
+
+    def send_many(self, items, connection=None, fail_silently=False,
+            raise_errors=False, **kwargs):
+        """
+        Renders and sends a message for each item in ``items``, reusing a
+        single email backend connection for the entire set of messages.
+
+        Each item should be a dictionary of keyword arguments that will be
+        passed to :meth:`render_to_message` for that message (for example,
+        ``{'extra_context': {'user': user}, 'to': (user.email,)}``.) Any
+        additional keyword arguments are used as defaults for every message,
+        and may be overridden by individual items.
+
+        Messages are rendered lazily as they are sent (using
+        :meth:`iter_messages`), so ``items`` may be an arbitrarily large
+        iterable.
+
+        :param items: An iterable of per-message keyword argument dictionaries.
+        :param connection: An email backend instance to use. If not provided,
+            the :attr:`connection_pool` is used (if set), or a new connection
+            will be created with :func:`~django.core.mail.get_connection`.
+        :param fail_silently: Whether or not backend errors should be
+            suppressed when creating a new connection.
+        :param raise_errors: Whether an error raised by the backend while
+            sending a message should stop sending and be raised. By default,
+            the error is logged, the message is reported as not sent, and the
+            remaining messages are still sent.
+        :returns: A list containing the number of messages sent by the backend
+            for each item (``1`` on success, ``0`` on failure), in the same
+            order as ``items``.
+        :rtype: :class:`list`
+        """
+        if connection is None:
+            connection = self.connection_pool
+        if connection is None:
+            connection = get_connection(fail_silently=fail_silently)
+
+        results = []
+
+        # The connection is only closed if it was opened here, which allows
+        # callers to provide a connection that they are managing themselves.
+        opened = connection.open()
+        try:
+            kwargs['connection'] = connection
+            for message in self.iter_messages(items, **kwargs):
+                # Messages are passed to the backend individually (as
+                # ``EmailMessage.send`` does) so that the result of each can
+                # be reported, while still sharing the open connection.
+                try:
+                    with timed(self, 'send'):
+                        sent = connection.send_messages([message])
+                except Exception:
+                    if raise_errors:
+                        raise
+                    sent = 0
+                    logger.exception('Could not send message %s with %r.',
+                        len(results), self)
+                results.append(sent or 0)
+        finally:
+            if opened:
+                connection.close()
+
+        return results
 
 
 class TemplatedEmailMessageView(EmailMessageView):
@@ -100,11 +587,52 @@ class TemplatedEmailMessageView(EmailMessageView):
     #: precedence over this value, if set.
     body_template_name = None
 
+    #: Whether templates resolved from the ``*_template_name`` attributes
+    #: should be cached for the lifetime of the process. The cache is
+    #: always bypassed when ``settings.DEBUG`` is enabled, so that template
+    #: changes are picked up during development.
+    cache_templates = True
+
+    #: Whether the plain text templates (the subject and body templates)
+    #: should be compiled with autoescaping disabled the first time they are
+    #: used, allowing them to be rendered directly with the message context.
+    #: If disabled, a copy of the context with autoescaping disabled is made
+    #: for rendering these templates instead.
+    compile_text_templates = True
+
+    # Resolved templates, keyed by a tuple of template names. This is shared
+    # between all subclasses, since the resolved template only depends on
+    # the template names (and the template settings.)
+    _template_cache = {}
+
+    @classmethod
+    def clear_template_cache(cls):
+        """
+        Discards all cached templates, causing them to be resolved through
+        the template loaders again on their next use.
+
+        This is called automatically when any of the template settings change,
+        and can also be called by development autoreloaders when template
+        source files are modified.
+        """
+        TemplatedEmailMessageView._template_cache.clear()
+
     def _get_template(self, value):
         if isinstance(value, (list, tuple)):
-            return select_template(value)
+            key = tuple(value)
+            load = select_template
         else:
-            return get_template(value)
+            key = (value,)
+            load = get_template
+
+        if not self.cache_templates or settings.DEBUG:
+            return load(value)
+
+        try:
+            return self._template_cache[key]
+        except KeyError:
+            template = self._template_cache[key] = load(value)
+            return template
 
     def _get_subject_template(self):
         if getattr(self, '_subject_template', None) is not None:
@@ -146,6 +674,19 @@ class TemplatedEmailMessageView(EmailMessageView):
     #: will be used instead.
     body_template = property(_get_body_template, _set_body_template)
 
+    def render_parts(self, context):
+        if not self.compile_text_templates:
+            # Unescape the context once for both of the plain text parts,
+            # rather than once for each of them.
+            context = unescape(context)
+        return super(TemplatedEmailMessageView, self).render_parts(context)
+
+    def _render_text_template(self, template, context):
+        if self.compile_text_templates:
+            return unescaped_template(template).render(context)
+        else:
+            return template.render(unescape(context))
+
     def render_subject(self, context):
         """
         Renders the message subject for the given context.
@@ -158,7 +699,7 @@ class TemplatedEmailMessageView(EmailMessageView):
         :returns: A rendered subject.
         :rtype: :class:`str`
         """
-        rendered = self.subject_template.render(unescape(context))
+        rendered = self._render_text_template(self.subject_template, context)
         return rendered.strip()
 
     def render_body(self, context):
@@ -173,7 +714,7 @@ class TemplatedEmailMessageView(EmailMessageView):
         :returns: A rendered body.
         :rtype: :class:`str`
         """
-        return self.body_template.render(unescape(context))
+        return self._render_text_template(self.body_template, context)
 
 
 class TemplatedHTMLEmailMessageView(TemplatedEmailMessageView):
@@ -188,6 +729,11 @@ class TemplatedHTMLEmailMessageView(TemplatedEmailMessageView):
     #: precedence over this value, if set.
     html_body_template_name = None
 
+    #: Whether the rules from any ``<style>`` elements in the rendered HTML
+    #: body should be inlined into the ``style`` attributes of the elements
+    #: they apply to. (See :mod:`mailviews.css` for the supported selectors.)
+    inline_css = False
+
     def _get_html_body_template(self):
         if getattr(self, '_html_body_template', None) is not None:
             return self._html_body_template
@@ -220,26 +766,38 @@ class TemplatedHTMLEmailMessageView(TemplatedEmailMessageView):
         """
         return self.html_body_template.render(context)
 
-    def render_to_message(self, extra_context=None, *args, **kwargs):
-        """
-        Renders and returns an unsent message with the given context.
+    def render_parts(self, context):
+        parts = super(TemplatedHTMLEmailMessageView, self).render_parts(context)
+        with timed(self, 'html_body'):
+            content = self.render_html_body(context)
 
-        Any extra keyword arguments passed will be passed through as keyword
-        arguments to the message constructor.
+        if self.inline_css:
+            with timed(self, 'inline_css'):
+                content = inline_css(content)
 
-        :param extra_context: Any additional context to use when rendering
-            templated content.
-        :type extra_context: :class:`dict`
-        :returns: A message instance.
-        :rtype: :attr:`.message_class`
-        """
-        message = super(TemplatedHTMLEmailMessageView, self)\
-            .render_to_message(extra_context, *args, **kwargs)
+        parts.alternatives.append((content, 'text/html'))
+        return parts
 
-        if extra_context is None:
-            extra_context = {}
 
-        context = self.get_context_data(**extra_context)
-        content = self.render_html_body(context)
-        message.attach_alternative(content, mimetype='text/html')
-        return message
+# The message view that is used to render messages within a worker process
+# started by :meth:`EmailMessageView.render_many`.
+_worker_view = None
+
+
+def _initialize_render_worker(view):
+    global _worker_view
+    _worker_view = view
+
+
+def _render_parts(extra_context):
+    with timed(_worker_view, 'context'):
+        context = _worker_view.get_context_data(**(extra_context or {}))
+    return _worker_view.render_cached_parts(context)
+
+
+def template_settings_changed(setting, **kwargs):
+    if setting in TEMPLATE_SETTINGS:
+        TemplatedEmailMessageView.clear_template_cache()
+
+
+setting_changed.connect(template_settings_changed)
@@ -0,0 +1,320 @@
+"""
+A durable outbox for messages that are rendered and sent outside of the
+process that created them, so that (for instance) web requests don't need to
+wait for an SMTP server to accept their messages.
+
+Messages are added to the outbox with :meth:`EmailMessageView.send_later
+<mailviews.messages.EmailMessageView.send_later>`, which stores the pickled
+message view along with its context and message keyword arguments in a local
+SQLite database. The ``mailviews_outbox`` management command drains the
+outbox with a pool of worker processes, sending each batch of messages
+through a single email backend connection.
+
+Messages are claimed by a worker for a limited time (the outbox's
+:attr:`~Outbox.lease`), and become available to other workers again if they
+haven't been sent or failed by the time the lease expires, such as when a
+worker is killed. Each message is removed from the outbox as soon as it has
+been sent, and the lease of the rest of a batch is renewed while it is being
+sent. Messages are therefore sent at least once, but a message may be sent
+again if a worker stops after sending it but before recording that it was
+sent (or if sending a single message takes longer than the lease.)
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+#: The name of the outbox database within the ``BASE_DIR`` setting, if the
+#: ``MAILVIEWS_OUTBOX`` setting is not provided.
+DEFAULT_FILENAME = 'mailviews-outbox.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload BLOB NOT NULL,
+    created REAL NOT NULL,
+    available REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_available ON messages (failed, available);
+"""
+
+
+class OutboxMessage(object):
+    """
+    A message that has been claimed from an :class:`Outbox`.
+    """
+    def __init__(self, id, payload, attempts, claimed=None):
+        self.id = id
+        self.payload = payload
+
+        #: The number of times this message has been claimed, including this
+        #: time.
+        self.attempts = attempts
+
+        #: The time at which the lease on this message was taken (or last
+        #: renewed.)
+        self.claimed = time.time() if claimed is None else claimed
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.id)
+
+    def load(self):
+        """
+        Returns the ``(view, extra_context, kwargs)`` of this message.
+        """
+        return pickle.loads(bytes(self.payload))
+
+
+class Outbox(object):
+    """
+    A queue of unsent messages, stored in a SQLite database.
+
+    Outboxes are safe to use from multiple threads and processes, although
+    each process uses its own connections to the database.
+
+    :param path: The path of the database file, which is created if it
+        doesn't exist.
+    """
+    #: The number of seconds that a worker has to send the messages it has
+    #: claimed before they are made available to other workers. The lease of
+    #: the unsent messages in a batch is renewed once half of it has passed.
+    lease = 300
+
+    #: The number of times sending a message will be attempted before it is
+    #: marked as failed. Failed messages remain in the database, but are not
+    #: claimed again.
+    max_attempts = 5
+
+    #: The number of seconds to wait before retrying a message that could not
+    #: be sent.
+    retry_delay = 60
+
+    def __init__(self, path):
+        self.path = path
+        self.__local = threading.local()
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.path)
+
+    def __len__(self):
+        """
+        Returns the number of messages waiting to be sent.
+        """
+        return self.__execute(
+            'SELECT COUNT(*) FROM messages WHERE failed = 0').fetchone()[0]
+
+    def __connect(self):
+        # SQLite connections can't be shared between threads, or used by
+        # forked processes.
+        pid, connection = getattr(self.__local, 'connection', (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30,
+                isolation_level=None)
+            connection.executescript(SCHEMA)
+            self.__local.connection = (os.getpid(), connection)
+        return connection
+
+    def __execute(self, sql, parameters=()):
+        return self.__connect().execute(sql, parameters)
+
+    def put(self, view, extra_context=None, **kwargs):
+        """
+        Adds a message to the outbox. The message view, context and keyword
+        arguments must be picklable.
+
+        :returns: The ID of the message in the outbox.
+        """
+        payload = pickle.dumps((view, extra_context, kwargs),
+            pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        return self.__execute('INSERT INTO messages (payload, created, '
+            'available) VALUES (?, ?, ?)',
+            (sqlite3.Binary(payload), now, now)).lastrowid
+
+    def claim(self, limit=100):
+        """
+        Claims up to ``limit`` of the available messages, in the order that
+        they were added. Claimed messages must be passed to :meth:`complete`
+        or :meth:`fail` before the :attr:`lease` expires.
+
+        :rtype: :class:`list` of :class:`OutboxMessage`
+        """
+        connection = self.__connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT id, payload, attempts FROM '
+                'messages WHERE failed = 0 AND available <= ? ORDER BY id '
+                'LIMIT ?', (now, limit)).fetchall()
+            connection.executemany('UPDATE messages SET available = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                [(now + self.lease, row[0]) for row in rows])
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+        return [OutboxMessage(id, payload, attempts + 1, now)
+            for id, payload, attempts in rows]
+
+    def renew(self, messages):
+        """
+        Renews the lease on claimed messages, so that they aren't claimed by
+        another worker while they are still waiting to be sent.
+        """
+        now = time.time()
+        self.__connect().executemany('UPDATE messages SET available = ? '
+            'WHERE id = ? AND failed = 0',
+            [(now + self.lease, message.id) for message in messages])
+        for message in messages:
+            message.claimed = now
+
+    def complete(self, messages):
+        """
+        Removes messages that have been sent from the outbox.
+        """
+        self.__connect().executemany('DELETE FROM messages WHERE id = ?',
+            [(message.id,) for message in messages])
+
+    def fail(self, message, error):
+        """
+        Records that a message could not be sent, making it available to be
+        retried after the :attr:`retry_delay` (or marking it as failed, if it
+        has been attempted :attr:`max_attempts` times.)
+        """
+        failed = message.attempts >= self.max_attempts
+        self.__execute('UPDATE messages SET available = ?, failed = ?, '
+            'error = ? WHERE id = ?', (time.time() + self.retry_delay,
+            int(failed), error, message.id))
+
+    def send(self, messages, connection=None):
+        """
+        Renders and sends claimed messages through a single email backend
+        connection, recording the result of each.
+
+        :param connection: An email backend instance to use. If not provided,
+            a new connection will be created with
+            :func:`~django.core.mail.get_connection`.
+        :returns: A ``(sent, failed)`` tuple of the number of messages that
+            were sent and that could not be sent.
+        """
+        if connection is None:
+            connection = get_connection()
+
+        try:
+            opened = connection.open()
+        except Exception as error:
+            for message in messages:
+                self.fail(message, '%s: %s' % (type(error).__name__, error))
+            logger.exception('Could not open a connection to send %s messages.',
+                len(messages))
+            return 0, len(messages)
+
+        sent = failed = 0
+        try:
+            for index, message in enumerate(messages):
+                if time.time() - message.claimed > self.lease / 2.0:
+                    self.renew(messages[index:])
+
+                try:
+                    view, extra_context, kwargs = message.load()
+                    kwargs['connection'] = connection
+                    if not connection.send_messages(
+                            [view.render_to_message(extra_context, **kwargs)]):
+                        raise ValueError('The message was not sent.')
+                except Exception as error:
+                    failed += 1
+                    self.fail(message, '%s: %s' % (type(error).__name__,
+                        error))
+                    logger.exception('Could not send %r.', message)
+                else:
+                    # Record each message as soon as it has been sent, so
+                    # that it isn't sent again if this worker stops.
+                    self.complete([message])
+                    sent += 1
+        finally:
+            if opened:
+                connection.close()
+
+        return sent, failed
+
+    def drain(self, batch_size=100, connection=None):
+        """
+        Sends messages in batches of ``batch_size`` until there are no more
+        available messages.
+
+        :returns: A ``(sent, failed)`` tuple of the number of messages that
+            were sent and that could not be sent.
+        """
+        total_sent = total_failed = 0
+        while True:
+            messages = self.claim(batch_size)
+            if not messages:
+                return total_sent, total_failed
+
+            sent, failed = self.send(messages, connection)
+            total_sent += sent
+            total_failed += failed
+
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_default_path():
+    """
+    Returns the path of the outbox database: the ``MAILVIEWS_OUTBOX`` setting,
+    or :data:`DEFAULT_FILENAME` within the ``BASE_DIR`` setting if it isn't
+    provided.
+
+    The path must be absolute, since a relative path would depend on the
+    working directory of each process, and processes started from different
+    directories (such as a web server and the ``mailviews_outbox`` command)
+    would silently use different outboxes.
+
+    :raises ImproperlyConfigured: if the path isn't absolute, or neither
+        setting is provided.
+    """
+    path = getattr(settings, 'MAILVIEWS_OUTBOX', None)
+    if path is None:
+        base = getattr(settings, 'BASE_DIR', None)
+        if base is None:
+            raise ImproperlyConfigured('The MAILVIEWS_OUTBOX setting (or the '
+                'BASE_DIR setting) must be provided to use the outbox.')
+        path = os.path.join(base, DEFAULT_FILENAME)
+
+    if not os.path.isabs(path):
+        raise ImproperlyConfigured('The path of the outbox must be absolute, '
+            'not %r.' % path)
+    return path
+
+
+def get_outbox(path=None):
+    """
+    Returns the :class:`Outbox` stored at the path (relative to the current
+    directory), or the :func:`default path <get_default_path>` if a path
+    isn't provided.
+    """
+    if path is None:
+        path = get_default_path()
+    else:
+        path = os.path.abspath(path)
+
+    with _outboxes_lock:
+        if path not in _outboxes:
+            _outboxes[path] = Outbox(path)
+        return _outboxes[path]
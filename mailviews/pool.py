@@ -0,0 +1,217 @@
+"""
+A thread-safe pool of open email backend connections, allowing concurrent
+senders (such as the threads of a WSGI server) to share a small number of
+established SMTP sessions rather than opening a new one for every message.
+"""
+import smtplib
+import socket
+import threading
+from timeit import default_timer
+
+from django.core.mail import get_connection
+
+
+def is_disconnected(error):
+    """
+    Returns whether an error raised while sending messages indicates that the
+    connection has been lost, and sending should be retried with a new
+    connection.
+    """
+    # SMTP exceptions are also socket errors on Python 3.
+    if isinstance(error, smtplib.SMTPException):
+        return isinstance(error, smtplib.SMTPServerDisconnected)
+    return isinstance(error, socket.error)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when a connection could not be acquired from a pool in time.
+    """
+
+
+class ConnectionPool(object):
+    """
+    A pool of open email backend connections.
+
+    Connections are opened as they are needed, up to a maximum number of
+    connections in use at once, and are closed once they have been idle for
+    longer than the idle timeout. Connections that have been idle for a
+    while are checked before they are reused (for SMTP connections, by
+    sending a ``NOOP`` command), and replaced if they have been closed by
+    the server.
+
+    Pools implement the email backend API, so they can be provided anywhere
+    that a backend instance is accepted (such as the ``connection`` argument
+    of :meth:`EmailMessageView.send
+    <mailviews.messages.EmailMessageView.send>`), or used as the
+    :attr:`~mailviews.messages.EmailMessageView.connection_pool` of a message
+    view. Opening and closing the pool itself has no effect; use
+    :meth:`clear` to close the idle connections.
+
+    :param backend: The dotted path of the email backend. Defaults to the
+        ``EMAIL_BACKEND`` setting.
+    :param max_size: The maximum number of connections in use at once.
+    :param idle_timeout: The number of seconds after which idle connections
+        are closed.
+    :param check_interval: The number of seconds that a connection can be
+        idle before it is checked when it is reused.
+    :param kwargs: Keyword arguments used to create each backend instance
+        (such as ``host`` or ``username``.)
+    """
+    def __init__(self, backend=None, max_size=4, idle_timeout=60,
+            check_interval=10, **kwargs):
+        self.backend = backend
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.kwargs = kwargs
+
+        self.__idle = []  # (connection, released), most recently used last
+        self.__size = 0  # The number of connections, idle or in use.
+        self.__condition = threading.Condition()
+
+    def __len__(self):
+        """
+        Returns the number of open connections, both idle and in use.
+        """
+        return self.__size
+
+    def open(self):
+        return False
+
+    def close(self):
+        pass
+
+    def create_connection(self):
+        """
+        Creates and opens a new backend connection.
+        """
+        connection = get_connection(self.backend, fail_silently=False,
+            **self.kwargs)
+        connection.open()
+        return connection
+
+    def check(self, connection):
+        """
+        Returns whether an idle connection is still usable.
+        """
+        if not hasattr(connection, 'connection'):
+            return True  # This backend doesn't use a network connection.
+
+        client = connection.connection
+        if client is None:
+            return False
+
+        try:
+            return client.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Returns an open connection from the pool, waiting for one to be
+        released if the maximum number of connections are in use. The
+        connection must be returned to the pool with :meth:`release`.
+
+        :param timeout: The maximum number of seconds to wait for a
+            connection, or ``None`` to wait indefinitely.
+        :raises PoolTimeout: if no connection was available in time.
+        """
+        deadline = None if timeout is None else default_timer() + timeout
+        expired = []
+        with self.__condition:
+            while True:
+                now = default_timer()
+                while self.__idle and now - self.__idle[0][1] > self.idle_timeout:
+                    expired.append(self.__idle.pop(0)[0])
+                    self.__size -= 1
+
+                if self.__idle:
+                    connection, released = self.__idle.pop()
+                    break
+                elif self.__size < self.max_size:
+                    connection, released = None, None
+                    self.__size += 1
+                    break
+
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout('No connection was available within '
+                        '%s seconds.' % timeout)
+                self.__condition.wait(remaining)
+
+        for idle in expired:
+            self.__close(idle)
+
+        if connection is not None and (default_timer() - released <=
+                self.check_interval or self.check(connection)):
+            return connection
+        elif connection is not None:
+            self.__close(connection)  # Replace the unusable connection.
+
+        try:
+            return self.create_connection()
+        except BaseException:
+            self.__discarded()
+            raise
+
+    def release(self, connection, discard=False):
+        """
+        Returns a connection to the pool, closing it instead if ``discard``
+        is true (such as when it is no longer usable.)
+        """
+        if discard:
+            self.__close(connection)
+            self.__discarded()
+            return
+
+        with self.__condition:
+            self.__idle.append((connection, default_timer()))
+            self.__condition.notify()
+
+    def clear(self):
+        """
+        Closes all of the idle connections in the pool.
+        """
+        with self.__condition:
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__condition.notify_all()
+
+        for connection, released in idle:
+            self.__close(connection)
+
+    def send_messages(self, email_messages):
+        """
+        Sends messages using a connection from the pool, retrying once with
+        a new connection if the connection has been lost.
+        """
+        for attempt in range(2):
+            connection = self.acquire()
+            try:
+                sent = connection.send_messages(email_messages)
+            except Exception as error:
+                if is_disconnected(error):
+                    self.release(connection, discard=True)
+                    if not attempt:
+                        continue
+                else:
+                    # Other SMTP errors (such as refused recipients) leave
+                    # the connection usable.
+                    self.release(connection, discard=not isinstance(error,
+                        smtplib.SMTPException))
+                raise
+
+            self.release(connection)
+            return sent
+
+    def __discarded(self):
+        with self.__condition:
+            self.__size -= 1
+            self.__condition.notify()
+
+    def __close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass  # The connection is being discarded anyway.
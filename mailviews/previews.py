@@ -1,13 +1,19 @@
+import functools
+import hashlib
 import logging
 import os
-from base64 import b64encode
+import threading
 from collections import namedtuple
 from email.header import decode_header
+from email.mime.base import MIMEBase
 
 import django
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+    HttpResponseNotModified)
 from django.shortcuts import render
+from django.utils import six
+from django.utils.encoding import force_bytes
 
 try:
     from collections import OrderedDict
@@ -21,7 +27,9 @@ except ImportError:
 
 from django.utils.module_loading import module_has_submodule
 
+from mailviews.cache import LRUCache
 from mailviews.helpers import should_use_staticfiles
+from mailviews.messages import serialize_message
 from mailviews.utils import split_docstring, unimplemented
 
 from django.conf.urls import include, url
@@ -32,6 +40,13 @@ logger = logging.getLogger(__name__)
 
 URL_NAMESPACE = 'mailviews'
 
+#: The query parameter that identifies the render that a part URL belongs to.
+RENDER_TOKEN_PARAMETER = 'render_token'
+
+#: The number of seconds that a message rendered for a preview detail page
+#: is kept for loading the parts of that page.
+RENDER_TIMEOUT = 10 * 60
+
 ModulePreviews = namedtuple('ModulePreviews', ('module', 'previews'))
 
 
@@ -46,27 +61,261 @@ def maybe_decode_header(header):
         return value
 
 
+def import_class(path):
+    """
+    Imports and returns a class (or any other module attribute) from its
+    dotted path.
+    """
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def get_html_alternative(message):
+    """
+    Returns the content of the ``text/html`` alternative of a message, or
+    ``None`` if it does not have one.
+    """
+    for content, mimetype in getattr(message, 'alternatives', ()):
+        if mimetype == 'text/html':
+            return content
+    return None
+
+
+#: Functions that return the value of a header from a message instance,
+#: keyed by the lowercase header name.
+MESSAGE_HEADERS = {
+    'subject': lambda message: message.subject,
+    'from': lambda message: message.from_email,
+    'to': lambda message: ', '.join(message.to),
+    'cc': lambda message: ', '.join(message.cc) or None,
+    'reply-to': lambda message: ', '.join(getattr(message, 'reply_to', ())) or None,
+}
+
+
+def get_raw_message(message):
+    """
+    Returns the encoded MIME message.
+    """
+    return serialize_message(message)
+
+
+def get_message_digest(message):
+    """
+    Returns a hex digest of the content of a message (excluding the headers
+    that change each time it is encoded, such as ``Message-ID`` and
+    ``Date``), so that identical renders have identical digests.
+    """
+    digest = hashlib.sha1()
+
+    def update(value):
+        value = force_bytes(value)
+        digest.update(force_bytes(len(value)))
+        digest.update(b':')
+        digest.update(value)
+
+    for value in (message.from_email, message.subject, message.body):
+        update(value)
+    for name in ('to', 'cc', 'bcc', 'reply_to'):
+        update(', '.join(getattr(message, name, None) or ()))
+    for name, value in sorted(message.extra_headers.items()):
+        update(name)
+        update(value)
+    for content, mimetype in getattr(message, 'alternatives', ()):
+        update(mimetype)
+        update(content)
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            update(attachment.as_string())
+        else:
+            for value in attachment:
+                update(value)
+    return digest.hexdigest()
+
+
+class PartSize(object):
+    """
+    The size of part of a message, in bytes.
+    """
+    #: The fraction of the limit at which a part is considered to be
+    #: approaching its limit.
+    warning_ratio = 0.8
+
+    def __init__(self, name, size, limit=None):
+        self.name = name
+        self.size = size
+        self.limit = limit
+
+    def __repr__(self):
+        return '<%s: %s (%s bytes)>' % (type(self).__name__, self.name, self.size)
+
+    @property
+    def status(self):
+        """
+        ``'error'`` if this part exceeds its limit, ``'warning'`` if it is
+        approaching its limit, and an empty string otherwise.
+        """
+        if self.limit is None:
+            return ''
+        elif self.size > self.limit:
+            return 'error'
+        elif self.size > self.limit * self.warning_ratio:
+            return 'warning'
+        return ''
+
+
+def measure_message(message, raw=None):
+    """
+    Returns a list of ``(name, size)`` tuples containing the size in bytes of
+    each part of the message: the subject, the plain text body, the HTML body
+    (if there is one), each attachment, and the encoded MIME message in total.
+
+    :param raw: The encoded MIME message, if it has already been encoded.
+    """
+    sizes = [
+        ('subject', len(force_bytes(message.subject))),
+        ('text', len(force_bytes(message.body))),
+    ]
+
+    html = get_html_alternative(message)
+    if html is not None:
+        sizes.append(('html', len(force_bytes(html))))
+
+    for attachment in message.attachments:
+        if isinstance(attachment, MIMEBase):
+            filename = attachment.get_filename()
+            size = len(force_bytes(attachment.as_string()))
+        else:
+            filename, content = attachment[:2]
+            size = len(force_bytes(content))
+        sizes.append(('attachment: %s' % (filename or 'unnamed'), size))
+
+    if raw is None:
+        raw = get_raw_message(message)
+    sizes.append(('total', len(raw)))
+    return sizes
+
+
+class RenderedPreview(object):
+    """
+    A message rendered for a preview detail page, along with the content of
+    each of its parts.
+
+    The content of each part is only computed once, so every part of the
+    page (including the encoded message, which has a different
+    ``Message-ID`` and ``Date`` each time it is encoded) comes from the same
+    render.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.__contents = {}
+        self.__lock = threading.Lock()
+
+    def get_content(self, function):
+        """
+        Returns the result of calling a part function (such as those in
+        :attr:`Preview.parts`) with the message.
+        """
+        with self.__lock:
+            try:
+                return self.__contents[function]
+            except KeyError:
+                content = self.__contents[function] = function(self.message)
+                return content
+
+
+#: Messages rendered by preview detail pages, keyed by the preview and the
+#: render token included in the URLs of the parts of the page.
+rendered_previews = LRUCache(max_size=20, sizeof=lambda rendered: 1)
+
+
 class PreviewSite(object):
     def __init__(self):
         self.__previews = {}
+        self.__pending = []
+        self.__deferred = []
+        self.__index = None
+        self.__lock = threading.RLock()
 
     def __iter__(self):
         """
-        Returns an iterator of :class:`ModulePreviews` tuples, sorted by module nae.
+        Returns an iterator of :class:`ModulePreviews` tuples, sorted by module name.
         """
-        for module in sorted(self.__previews.keys()):
-            previews = ModulePreviews(module, sorted(self.__previews[module].values(), key=str))
-            yield previews
+        return iter(self.index)
+
+    @property
+    def index(self):
+        """
+        A list of :class:`ModulePreviews` tuples, sorted by module name.
+
+        The index is only sorted when it is first used after a preview has
+        been registered.
+        """
+        with self.__lock:
+            self.__load()
+            if self.__index is None:
+                self.__index = [ModulePreviews(module, sorted(previews.values(), key=str))
+                    for module, previews in sorted(self.__previews.items())]
+            return self.__index
 
     def register(self, cls):
         """
         Adds a preview to the index.
+
+        The preview can either be a :class:`Preview` subclass, or the dotted
+        path to one. Previews registered by path are not imported (or
+        instantiated) until the index is first used.
+        """
+        with self.__lock:
+            if isinstance(cls, six.string_types):
+                logger.debug('Registering %r with %r', cls, self)
+                self.__pending.append(cls)
+            else:
+                self.__add(cls)
+            self.__index = None
+
+    def defer(self, function):
+        """
+        Defers calling a function (such as one that registers previews) until
+        the index is first used.
         """
+        with self.__lock:
+            self.__deferred.append(function)
+            self.__index = None
+
+    def get_preview(self, module, name):
+        """
+        Returns the registered preview for the module and preview class name,
+        raising :class:`KeyError` if it does not exist.
+        """
+        with self.__lock:
+            self.__load()
+            return self.__previews[module][name]
+
+    def __add(self, cls):
         preview = cls(site=self)
         logger.debug('Registering %r with %r', preview, self)
         index = self.__previews.setdefault(preview.module, {})
         index[cls.__name__] = preview
 
+    def __load(self):
+        # Each function or path is put back if it fails, so that it is tried
+        # again the next time the index is used rather than being skipped.
+        while self.__deferred:
+            function = self.__deferred.pop(0)
+            try:
+                function()
+            except BaseException:
+                self.__deferred.insert(0, function)
+                raise
+
+        while self.__pending:
+            path = self.__pending.pop(0)
+            try:
+                self.__add(import_class(path))
+            except BaseException:
+                self.__pending.insert(0, path)
+                raise
+
     @property
     def urls(self):
 
@@ -74,6 +323,9 @@ class PreviewSite(object):
             url(regex=r'^$',
                 view=self.list_view,
                 name='list'),
+            url(regex=r'^(?P<module>.+)/(?P<preview>.+)/(?P<part>%s)/$' % '|'.join(Preview.parts),
+                view=self.part_view,
+                name='part'),
             url(regex=r'^(?P<module>.+)/(?P<preview>.+)/$',
                 view=self.detail_view,
                 name='detail'),
@@ -96,7 +348,19 @@ class PreviewSite(object):
     def list_view(self, request):
         """
         Returns a list view response containing all of the registered previews.
+
+        The sizes shown are from the most recent render of each preview. If
+        the ``measure`` query parameter is provided, every preview is rendered
+        (using its sample data) and measured first.
         """
+        if 'measure' in request.GET:
+            for previews in self:
+                for preview in previews.previews:
+                    try:
+                        preview.measure(preview.render_sample_message(request))
+                    except Exception:
+                        logger.warning('Could not measure %r', preview, exc_info=True)
+
         return render(request, 'mailviews/previews/list.html', {
             'site': self,
         })
@@ -106,11 +370,22 @@ class PreviewSite(object):
         Looks up a preview in the index, returning a detail view response.
         """
         try:
-            preview = self.__previews[module][preview]
+            preview = self.get_preview(module, preview)
         except KeyError:
             raise Http404  # The provided module/preview does not exist in the index.
         return preview.detail_view(request)
 
+    def part_view(self, request, module, preview, part):
+        """
+        Looks up a preview in the index, returning a response containing a
+        single part of the rendered message.
+        """
+        try:
+            preview = self.get_preview(module, preview)
+        except KeyError:
+            raise Http404  # The provided module/preview does not exist in the index.
+        return preview.part_view(request, part)
+
 
 class Preview(object):
     #: The message view class that will be instantiated to render the preview
@@ -128,12 +403,41 @@ class Preview(object):
     # of the message view class.
     form_class = None
 
+    #: The form data to use when rendering this preview outside of the preview
+    #: site (such as when exporting previews.) If not provided, the initial
+    #: values of the :attr:`form_class` fields are used.
+    sample_data = None
+
     #: The template that will be rendered for this preview.
     template_name = 'mailviews/previews/detail.html'
 
+    #: The maximum size, in bytes, of the parts of the message (keyed by the
+    #: names used by :func:`measure_message`.) Parts that exceed or approach
+    #: their limit are flagged in the preview site. By default, HTML bodies
+    #: are limited to the size at which Gmail clips messages.
+    size_limits = {
+        'html': 102 * 1024,
+    }
+
+    #: The parts of a message that can be loaded separately from the preview
+    #: detail page, as a mapping of the part name to a ``(function,
+    #: content_type)`` tuple. The function returns the content of the part
+    #: from a message, or ``None`` if the message doesn't have that part.
+    parts = {
+        'html': (get_html_alternative, 'text/html; charset=utf-8'),
+        'source': (get_html_alternative, 'text/plain; charset=utf-8'),
+        'text': (lambda message: message.body, 'text/plain; charset=utf-8'),
+        'raw': (get_raw_message, 'text/plain; charset=utf-8'),
+        'eml': (get_raw_message, 'message/rfc822'),
+    }
+
     def __init__(self, site):
         self.site = site
 
+        #: The :class:`PartSize` of each part of the most recently rendered
+        #: message for this preview, or ``None`` if it has not been rendered.
+        self.sizes = None
+
     def __unicode__(self):
         return self.verbose_name or self.message_view.__name__
 
@@ -141,6 +445,28 @@ class Preview(object):
     def module(self):
         return '%s' % self.message_view.__module__
 
+    @property
+    def size_status(self):
+        """
+        The most severe :attr:`PartSize.status` of the most recently rendered
+        message for this preview.
+        """
+        statuses = set(size.status for size in self.sizes or ())
+        for status in ('error', 'warning'):
+            if status in statuses:
+                return status
+        return ''
+
+    @property
+    def total_size(self):
+        """
+        The encoded size of the most recently rendered message for this
+        preview, or ``None`` if it has not been rendered.
+        """
+        if self.sizes:
+            return self.sizes[-1].size
+        return None
+
     @property
     def description(self):
         """
@@ -161,76 +487,289 @@ class Preview(object):
             'preview': type(self).__name__,
         })
 
+    def get_part_url(self, part):
+        """
+        The URL to access a single part of this preview.
+        """
+        return reverse('%s:part' % URL_NAMESPACE, kwargs={
+            'module': self.module,
+            'preview': type(self).__name__,
+            'part': part,
+        })
+
     def get_message_view(self, request, **kwargs):
         return self.message_view(**kwargs)
 
+    def get_form(self, request):
+        """
+        Returns a bound instance of the :attr:`form_class` if the request
+        contains any query parameters, otherwise an unbound instance.
+        """
+        if request.GET:
+            return self.form_class(data=request.GET)
+        else:
+            return self.form_class()
+
+    def get_sample_data(self):
+        """
+        Returns the form data to use when rendering a sample of this preview
+        (such as when measuring or exporting previews.)
+        """
+        if self.sample_data is not None:
+            return self.sample_data
+
+        form = self.form_class()
+        data = {}
+        for name in form.fields:
+            value = form[name].value()
+            if value is not None:
+                data[name] = value
+        return data
+
+    def render_message(self, request, form=None):
+        """
+        Renders the message for this preview, using the keyword arguments
+        provided by a valid form (if this preview has a form.)
+        """
+        kwargs = {}
+        if form is not None:
+            kwargs.update(form.get_message_view_kwargs())
+
+        message_view = self.get_message_view(request, **kwargs)
+        return message_view.render_to_message()
+
+    def render_sample_message(self, request=None):
+        """
+        Renders the message for this preview using the :meth:`get_sample_data`
+        if this preview has a form.
+
+        :param request: The current request, or ``None`` if the message is
+            rendered outside of the preview site (such as when exporting.)
+        :raises ValueError: if the sample data isn't valid.
+        """
+        form = None
+        if self.form_class:
+            form = self.form_class(data=self.get_sample_data())
+            if not form.is_valid():
+                raise ValueError('Invalid sample data: %s' % form.errors.as_text())
+
+        return self.render_message(request, form)
+
+    def measure(self, message, raw=None):
+        """
+        Measures the size of each part of the message, recording the results
+        as the :attr:`sizes` of this preview.
+
+        :param raw: The encoded MIME message, if it has already been encoded.
+        """
+        self.sizes = [PartSize(name, size, self.size_limits.get(name))
+            for name, size in measure_message(message, raw)]
+        return self.sizes
+
+    def get_render_key(self, token):
+        return '%s.%s:%s' % (self.module, type(self).__name__, token)
+
+    def get_headers(self, message):
+        """
+        Returns an ordered dictionary of the values of :attr:`headers` for
+        the message.
+
+        Where possible, the values are read from the message instance, since
+        reading them from the MIME message requires encoding all of the
+        message content.
+        """
+        extra_headers = dict((name.lower(), value)
+            for name, value in message.extra_headers.items())
+
+        headers = OrderedDict()
+        raw = None
+        for header in self.headers:
+            name = header.lower()
+            if name in extra_headers:
+                value = extra_headers[name]
+            elif name in MESSAGE_HEADERS:
+                value = MESSAGE_HEADERS[name](message)
+            else:
+                if raw is None:
+                    raw = message.message()
+                value = raw[header]
+                if value is not None:
+                    value = maybe_decode_header(value)
+            headers[header] = value
+        return headers
+
     def detail_view(self, request):
         """
         Renders the message view to a response.
+
+        The HTML content and raw message are not included in the response,
+        and are loaded separately using :meth:`part_view`. The rendered
+        message is kept for a short time (under a token that is included in
+        the part URLs), so that the parts show the same message as the page
+        without rendering it again.
+
+        The token is a digest of the message content, so the part URLs (and
+        their ``ETag`` values) stay the same while the content doesn't
+        change, and repeated loads reuse the message that is already kept.
         """
         context = {
             'preview': self,
         }
 
-        kwargs = {}
+        form = None
         if self.form_class:
-            if request.GET:
-                form = self.form_class(data=request.GET)
-            else:
-                form = self.form_class()
-
+            form = self.get_form(request)
             context['form'] = form
             if not form.is_bound or not form.is_valid():
                 return render(request, 'mailviews/previews/detail.html', context)
 
-            kwargs.update(form.get_message_view_kwargs())
-
-        message_view = self.get_message_view(request, **kwargs)
+        message = self.render_message(request, form)
+        token = get_message_digest(message)
+        key = self.get_render_key(token)
+        rendered = rendered_previews.get(key)
+        if rendered is None:
+            rendered = RenderedPreview(message)
+        else:
+            message = rendered.message
+        rendered_previews.set(key, rendered, RENDER_TIMEOUT)
 
-        message = message_view.render_to_message()
-        raw = message.message()
-        headers = OrderedDict((header, maybe_decode_header(raw[header])) for header in self.headers)
+        query = request.GET.copy()
+        query[RENDER_TOKEN_PARAMETER] = token
+        query = query.urlencode()
 
         context.update({
             'message': message,
             'subject': message.subject,
             'body': message.body,
-            'headers': headers,
-            'raw': raw.as_string(),
+            'headers': self.get_headers(message),
+            'sizes': self.measure(message,
+                rendered.get_content(get_raw_message)),
+            'html': get_html_alternative(message) is not None,
+            'parts': dict((part, '%s?%s' % (self.get_part_url(part), query))
+                for part in self.parts),
         })
 
-        alternatives = getattr(message, 'alternatives', [])
-        try:
-            html = next(alternative[0] for alternative in alternatives
-                if alternative[1] == 'text/html')
-            context.update({
-                'html': html,
-                'escaped_html': b64encode(html.encode('utf-8')),
-            })
-        except StopIteration:
-            pass
-
         return render(request, self.template_name, context)
 
+    def part_view(self, request, part):
+        """
+        Returns a response containing a single part of the message.
 
-def autodiscover():
+        If the request includes the render token of a detail page, the part
+        is taken from the message rendered for that page. Otherwise (or if
+        that message has expired), the message view is rendered again.
+
+        Responses have an ``ETag`` header, and a not modified response is
+        returned if the content matches the request's ``If-None-Match``
+        header. HTML responses are sandboxed (with a
+        ``Content-Security-Policy`` header), so that scripts in the message
+        can't run with the preview site's origin.
+        """
+        rendered = None
+        token = request.GET.get(RENDER_TOKEN_PARAMETER)
+        if token:
+            rendered = rendered_previews.get(self.get_render_key(token))
+
+        if rendered is None:
+            form = None
+            if self.form_class:
+                form = self.get_form(request)
+                if not form.is_valid():
+                    return HttpResponseBadRequest()
+            rendered = RenderedPreview(self.render_message(request, form))
+
+        get_content, content_type = self.parts[part]
+        content = rendered.get_content(get_content)
+        if content is None:
+            raise Http404  # The message does not contain this part.
+
+        content = force_bytes(content)
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        matches = [value.strip() for value in
+            request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in matches or '*' in matches:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type=content_type)
+            if part == 'eml':
+                response['Content-Disposition'] = 'attachment; filename="%s.eml"' % type(self).__name__
+
+        response['ETag'] = etag
+        if content_type.startswith('text/html'):
+            response['Content-Security-Policy'] = 'sandbox'
+        return response
+
+
+def get_application_names():
     """
-    Imports all available previews classes.
+    Returns the package names of all installed applications.
+    """
+    try:
+        from django.apps import apps
+    except ImportError:  # Django < 1.7
+        from django.conf import settings
+        return list(settings.INSTALLED_APPS)
+    return [config.name for config in apps.get_app_configs()]
+
+
+def discover_preview_modules():
     """
-    from django.conf import settings
-    for application in settings.INSTALLED_APPS:
+    Imports the ``emails.previews`` submodule of every installed application
+    that has one, returning a list of the names of the imported modules.
+    """
+    modules = []
+    for application in get_application_names():
         module = import_module(application)
 
         if module_has_submodule(module, 'emails'):
             emails = import_module('%s.emails' % application)
+            name = '%s.emails.previews' % application
             try:
-                import_module('%s.emails.previews' % application)
+                import_module(name)
             except ImportError:
                 # Only raise the exception if this module contains previews and
                 # there was a problem importing them. (An emails module that
                 # does not contain previews is not an error.)
                 if module_has_submodule(emails, 'previews'):
                     raise
+            else:
+                modules.append(name)
+    return modules
+
+
+def autodiscover(manifest=None, lazy=False):
+    """
+    Imports all available previews classes.
+
+    :param manifest: The path to a file that is used to store the names of
+        the modules containing previews. If the file exists, only the modules
+        it lists are imported, and the installed applications are not
+        searched. If it does not exist, it is created after searching the
+        installed applications. (The file should be removed whenever previews
+        are added to, or removed from, an application.)
+    :param lazy: If true, discovery is deferred until the default preview site
+        is first used, so that processes that never serve previews (such as
+        mail workers) do not import any preview modules.
+    """
+    if lazy:
+        site.defer(functools.partial(autodiscover, manifest=manifest))
+        return
+
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest) as f:
+            for name in f.read().split():
+                import_module(name)
+        return
+
+    modules = discover_preview_modules()
+
+    if manifest is not None:
+        # Write the manifest atomically, so that other processes never read
+        # a partially written manifest.
+        temporary = '%s.%s.tmp' % (manifest, os.getpid())
+        with open(temporary, 'w') as f:
+            f.write(''.join('%s\n' % name for name in modules))
+        os.rename(temporary, manifest)
 
 
 #: The default preview site.
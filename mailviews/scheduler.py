@@ -0,0 +1,490 @@
+"""
+Schedulers for sending large numbers of messages as quickly as an email
+provider's rate limits allow, and for sending urgent messages ahead of bulk
+messages.
+"""
+import logging
+import threading
+from collections import deque
+import time
+from timeit import default_timer
+
+from django.core.mail import get_connection
+
+from mailviews.pool import is_disconnected
+from mailviews.utils import close_idle_connections, timed
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    A thread-safe rate limiter, allowing ``rate`` events per second on
+    average with bursts of up to ``capacity`` events.
+
+    Rather than polling for tokens, each caller reserves a token (even if
+    the bucket is empty) and sleeps until the time at which that token will
+    have been added to the bucket, so waiting callers are released in order
+    at exactly the limited rate.
+
+    :param rate: The number of events allowed per second.
+    :param capacity: The maximum number of events allowed in a burst.
+        Defaults to one, which spaces events evenly.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+
+        self.__tokens = float(capacity)
+        self.__updated = default_timer()
+        self.__lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Takes tokens from the bucket, returning the number of seconds until
+        they are available.
+        """
+        with self.__lock:
+            now = default_timer()
+            self.__tokens = min(self.capacity,
+                self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            self.__tokens -= tokens
+            return max(0, -self.__tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        """
+        Takes tokens from the bucket, waiting until they are available.
+        """
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+class SendReport(object):
+    """
+    The results of sending a set of messages with a :class:`SendScheduler`.
+    """
+    def __init__(self, results, elapsed, error=None):
+        #: The number of messages sent by the backend for each item (``1`` on
+        #: success, ``0`` on failure), in the same order as the items. If no
+        #: connection could be opened, this only includes the items that
+        #: were consumed before sending stopped.
+        self.results = results
+
+        #: The number of seconds taken to send all of the messages.
+        self.elapsed = elapsed
+
+        #: The first error raised while opening a connection, or ``None``.
+        self.error = error
+
+    def __repr__(self):
+        return '<%s: %s sent, %s failed, %.1f/s>' % (type(self).__name__,
+            self.sent, self.failed, self.throughput)
+
+    @property
+    def sent(self):
+        return sum(self.results)
+
+    @property
+    def failed(self):
+        return len(self.results) - self.sent
+
+    @property
+    def throughput(self):
+        """
+        The number of messages sent per second.
+        """
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+
+class BaseScheduler(object):
+    """
+    Base class for schedulers that send messages over several email backend
+    connections at once, limiting the rate of messages sent by each
+    connection and by all of the connections combined.
+
+    :param connections: The number of connections to send messages with.
+    :param rate: The maximum number of messages sent per second by all of
+        the connections combined (such as a provider's per-account limit),
+        or ``None`` for no limit.
+    :param connection_rate: The maximum number of messages sent per second
+        by each connection, or ``None`` for no limit.
+    :param backend: The dotted path of the email backend. Defaults to the
+        ``EMAIL_BACKEND`` setting.
+    :param kwargs: Keyword arguments used to create each backend instance.
+    """
+    def __init__(self, connections=1, rate=None, connection_rate=None,
+            backend=None, **kwargs):
+        self.connections = connections
+        self.rate = rate
+        self.connection_rate = connection_rate
+        self.backend = backend
+        self.kwargs = kwargs
+
+    def create_connection(self):
+        connection = get_connection(self.backend, fail_silently=False,
+            **self.kwargs)
+        connection.open()
+        return connection
+
+    def create_limits(self, limit):
+        """
+        Returns the rate limiters for a connection, given the limiter shared
+        by all of the connections (if there is one.)
+        """
+        limits = [limit] if limit is not None else []
+        if self.connection_rate:
+            limits.insert(0, TokenBucket(self.connection_rate))
+        return limits
+
+    def send_message(self, view, connection, limits, options):
+        """
+        Renders a message with the message view and sends it once the rate
+        limits allow, reconnecting and retrying once if the connection has
+        been lost.
+
+        :returns: The number of messages sent by the backend.
+        """
+        options = dict(options, connection=connection)
+        message = view.render_to_message(**options)
+
+        for limit in limits:
+            limit.acquire()
+
+        with timed(view, 'send'):
+            try:
+                sent = connection.send_messages([message])
+            except Exception as error:
+                if not is_disconnected(error):
+                    raise
+                connection.close()
+                connection.open()
+                sent = connection.send_messages([message])
+        return sent or 0
+
+
+class SendScheduler(BaseScheduler):
+    """
+    Renders and sends a set of messages over several email backend
+    connections at once, within the rate limits.
+
+    Each connection is used by its own thread, which renders a message and
+    then waits for the rate limits to allow it to be sent, so every
+    connection is kept busy up to the limits. If a connection can't be
+    opened, the messages are sent by the other connections. (Threads are used rather than
+    processes since sending is mostly spent waiting on the network; use
+    :meth:`~mailviews.messages.EmailMessageView.render_many` to distribute
+    rendering across processes instead.)
+
+    See :class:`BaseScheduler` for the accepted arguments.
+    """
+    def send(self, view, items, **kwargs):
+        """
+        Renders and sends a message with the message view for each item in
+        ``items``.
+
+        Items have the same format as those accepted by
+        :meth:`~mailviews.messages.EmailMessageView.send_many`, and any
+        additional keyword arguments are used as defaults for every message.
+        Items are consumed lazily, so ``items`` may be an arbitrarily large
+        iterable.
+
+        Errors are never raised, so that the results of the messages that
+        were sent are always returned: the report's
+        :attr:`~SendReport.error` is set if a connection couldn't be opened.
+
+        :returns: A report of the results and the throughput achieved.
+        :rtype: :class:`SendReport`
+        """
+        # Build the shared context once, rather than in each thread.
+        view.base_context
+
+        state = {
+            'items': enumerate(items),
+            'consumed': 0,
+            'lock': threading.Lock(),
+            'results': {},
+            'errors': [],
+            'limit': TokenBucket(self.rate) if self.rate else None,
+        }
+
+        start = default_timer()
+        threads = [threading.Thread(target=self.__run,
+            args=(view, state, kwargs)) for i in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = default_timer() - start
+
+        # Any item that was consumed without a result wasn't sent.
+        results = [state['results'].get(index, 0)
+            for index in range(state['consumed'])]
+        error = state['errors'][0] if state['errors'] else None
+        report = SendReport(results, elapsed, error)
+        logger.info('Sent %s messages in %.2f seconds (%.1f messages per '
+            'second, %s failed.)', report.sent, report.elapsed,
+            report.throughput, report.failed)
+        return report
+
+    def __run(self, view, state, kwargs):
+        limits = self.create_limits(state['limit'])
+
+        try:
+            connection = self.create_connection()
+        except Exception as error:
+            # The remaining messages are sent by the other connections.
+            logger.exception('Could not open a connection.')
+            with state['lock']:
+                state['errors'].append(error)
+            return
+
+        try:
+            while True:
+                with state['lock']:
+                    try:
+                        index, item = next(state['items'])
+                    except StopIteration:
+                        return
+                    state['consumed'] = index + 1
+
+                try:
+                    sent = self.send_message(view, connection, limits,
+                        dict(kwargs, **item))
+                except Exception:
+                    sent = 0
+                    logger.exception('Could not send message %s.', index)
+
+                state['results'][index] = sent
+        finally:
+            connection.close()
+            close_idle_connections()
+
+
+class LaneStats(object):
+    """
+    The number of messages sent from a :class:`PriorityScheduler` lane, and
+    their latency (the time from when they were submitted until they were
+    sent.)
+    """
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __repr__(self):
+        return '<%s: %s sent, %s failed, %.3fs mean latency>' % (
+            type(self).__name__, self.sent, self.failed, self.mean_latency)
+
+    @property
+    def mean_latency(self):
+        count = self.sent + self.failed
+        return self.total_latency / count if count else 0.0
+
+    def add(self, sent, latency):
+        if sent:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+class PriorityScheduler(BaseScheduler):
+    """
+    Sends messages submitted from any thread over several email backend
+    connections, keeping messages in separate lanes by priority.
+
+    Whenever a connection is ready to send another message, it takes the
+    next message from the highest priority lane that has messages waiting,
+    so (for instance) password reset messages are sent ahead of a newsletter
+    that is already being sent, rather than waiting for it to finish.
+    Messages are sent in the order they were submitted within each lane,
+    although a submission whose iterable is slow to produce its next item
+    doesn't hold up the other submissions (or the connections sending
+    them) while it does.
+
+    If an iterable of submitted items raises an exception, the rest of that
+    submission is dropped and counted as one failure in its lane's
+    :attr:`stats`.
+
+    The priority of a message is the
+    :attr:`~mailviews.messages.EmailMessageView.priority` of its message
+    view, unless it is provided when the message is submitted. Lower values
+    are sent first.
+
+    Schedulers must be started with :meth:`start` (or used as a context
+    manager) before messages are sent. See :class:`BaseScheduler` for the
+    accepted arguments.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PriorityScheduler, self).__init__(*args, **kwargs)
+
+        #: The :class:`LaneStats` for each lane, keyed by priority.
+        self.stats = {}
+
+        self.__lanes = {}  # priority: deque of [view, items, kwargs, submitted]
+        self.__condition = threading.Condition()
+        self.__threads = []
+        self.__stopping = False
+        self.__fetching = 0  # Submissions taken out of lanes for next().
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __len__(self):
+        """
+        Returns the number of submissions waiting to be sent.
+        """
+        with self.__condition:
+            return self.__fetching + sum(len(lane)
+                for lane in self.__lanes.values())
+
+    def submit(self, view, extra_context=None, priority=None, **kwargs):
+        """
+        Submits a message to be rendered and sent by the scheduler. The
+        arguments are the same as those accepted by
+        :meth:`~mailviews.messages.EmailMessageView.send`.
+
+        :param priority: The priority of the message. Defaults to the
+            priority of the message view.
+        """
+        self.submit_many(view, [{'extra_context': extra_context}],
+            priority=priority, **kwargs)
+
+    def submit_many(self, view, items, priority=None, **kwargs):
+        """
+        Submits a message for each item in ``items`` to be rendered and sent
+        by the scheduler. The arguments are the same as those accepted by
+        :meth:`~mailviews.messages.EmailMessageView.send_many`, and items are
+        consumed lazily as messages are sent.
+
+        :param priority: The priority of the messages. Defaults to the
+            priority of the message view.
+        """
+        if priority is None:
+            priority = view.priority
+
+        with self.__condition:
+            if self.__stopping:
+                raise RuntimeError('The scheduler has been stopped.')
+            self.__lanes.setdefault(priority, deque()).append(
+                [view, iter(items), kwargs, default_timer()])
+            self.__condition.notify_all()
+
+    def start(self):
+        """
+        Opens the connections and starts sending messages.
+        """
+        limit = TokenBucket(self.rate) if self.rate else None
+        connections = []
+        try:
+            for i in range(self.connections):
+                connections.append(self.create_connection())
+        except BaseException:
+            for connection in connections:
+                connection.close()
+            raise
+
+        for connection in connections:
+            thread = threading.Thread(target=self.__run,
+                args=(connection, self.create_limits(limit)))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        """
+        Waits for all of the submitted messages to be sent, and then closes
+        the connections.
+        """
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+
+        for thread in self.__threads:
+            thread.join()
+        del self.__threads[:]
+
+    def __take(self):
+        """
+        Takes the submission at the head of the highest priority lane that
+        has any waiting, returning its priority and lane along with it.
+        """
+        with self.__condition:
+            while True:
+                for priority in sorted(self.__lanes):
+                    lane = self.__lanes[priority]
+                    if lane:
+                        self.__fetching += 1
+                        return priority, lane, lane.popleft()
+
+                # A submission that is being fetched from may be returned
+                # to its lane, so wait for it before stopping.
+                if self.__stopping and not self.__fetching:
+                    return None
+                self.__condition.wait()
+
+    def __next(self):
+        while True:
+            taken = self.__take()
+            if taken is None:
+                return None
+
+            # The lock isn't held while getting the next item, since the
+            # iterable may be slow (such as a queryset iterator fetching its
+            # next chunk) and would block other connections and submissions.
+            priority, lane, entry = taken
+            view, items, kwargs, submitted = entry
+            options = failed = None
+            try:
+                options = dict(kwargs, **next(items))
+            except StopIteration:
+                pass
+            except Exception:
+                # Drop the rest of the submission (such as a queryset
+                # iterator that raised a database error), rather than
+                # stopping this thread.
+                failed = True
+                logger.exception('Could not get the next item submitted '
+                    'with %r.', view)
+
+            with self.__condition:
+                self.__fetching -= 1
+                if options is not None:
+                    lane.appendleft(entry)
+                elif failed:
+                    self.stats.setdefault(priority, LaneStats()).add(0,
+                        default_timer() - submitted)
+                self.__condition.notify_all()
+
+            if options is not None:
+                return priority, view, options, submitted
+
+    def __run(self, connection, limits):
+        try:
+            while True:
+                entry = self.__next()
+                if entry is None:
+                    return
+
+                priority, view, options, submitted = entry
+                try:
+                    sent = self.send_message(view, connection, limits, options)
+                except Exception:
+                    sent = 0
+                    logger.exception('Could not send a message with %r.', view)
+
+                with self.__condition:
+                    self.stats.setdefault(priority, LaneStats()).add(sent,
+                        default_timer() - submitted)
+        finally:
+            connection.close()
+            close_idle_connections()
@@ -0,0 +1,31 @@
+from django.dispatch import Signal
+
+
+#: Sent when a phase of rendering or sending a message has completed. The
+#: sender is the message view class, and the arguments provided are the
+#: message view instance (``view``), the name of the phase (``phase``) and
+#: the time that the phase took to complete, in seconds (``duration``.)
+#:
+#: The phases that are timed are:
+#:
+#: * ``context``: building the message context with ``get_context_data``,
+#: * ``subject``: rendering the message subject,
+#: * ``body``: rendering the plain text message body,
+#: * ``html_body``: rendering the HTML message body,
+#: * ``inline_css``: inlining the HTML body stylesheet (when enabled),
+#: * ``message``: constructing the message instance from its rendered parts
+#:   (and the attachments of the message view),
+#: * ``serialize``: building and encoding the MIME message, with
+#:   ``render_to_serialized_message`` or ``render_to_bytes``,
+#: * ``send``: sending the message with the email backend.
+#:
+#: Message instances build their MIME message lazily, when they are sent, so
+#: the ``send`` phase of a message that hasn't already been serialized also
+#: includes the time taken to build and encode the MIME message. To time the
+#: MIME message separately, render it with ``render_to_serialized_message`` and
+#: send the result with :class:`mailviews.backends.smtp.EmailBackend`, which
+#: sends the encoded content without encoding it again.
+#:
+#: When rendering with ``render_many``, the rendering phases are timed (and
+#: this signal is sent) within the worker processes.
+phase_timed = Signal(providing_args=('view', 'phase', 'duration'))
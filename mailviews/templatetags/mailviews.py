@@ -1,6 +1,17 @@
 from __future__ import absolute_import
 
+import hashlib
+
 from django import template
+from django.utils.encoding import force_bytes
+
+try:
+    from django.core.cache import caches
+except ImportError:  # Django < 1.7
+    from django.core.cache import get_cache as cache_for_alias
+else:
+    def cache_for_alias(alias):
+        return caches[alias]
 
 from mailviews.helpers import should_use_staticfiles
 from mailviews.previews import URL_NAMESPACE
@@ -21,3 +32,96 @@ def mailviews_static(path):
 
 
 register.simple_tag(mailviews_static)
+
+
+class MailCacheNode(template.Node):
+    """
+    Renders a cached template fragment for the ``{% mailcache %}`` tag.
+
+    This is similar to the ``CacheNode`` of Django's built-in ``{% cache %}``
+    tag, which isn't used (or subclassed) for these reasons:
+
+    * Its cache key doesn't include whether autoescaping is enabled, so a
+      fragment shared by the plain text and HTML templates of a message would
+      be cached once and rendered with the wrong escaping in one of them.
+    * It requires an expiry time, rather than allowing the cache's default
+      timeout to be used.
+    * Its constructor, and the way it builds cache keys, differ between the
+      versions of Django supported by mailviews (``using=`` isn't supported
+      before Django 1.7), so a subclass would need to handle each of them.
+    """
+    def __init__(self, nodelist, fragment_name, vary_on, timeout=None,
+            using=None):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+        self.timeout = timeout
+        self.using = using
+
+    def get_cache_key(self, context):
+        digest = hashlib.md5()
+        for value in self.vary_on:
+            digest.update(force_bytes(value.resolve(context)))
+            digest.update(b':')
+
+        # The same fragment renders differently in plain text (unescaped) and
+        # HTML (escaped) templates, so they are cached separately.
+        digest.update(b'escaped' if context.autoescape else b'unescaped')
+        return 'mailviews:fragment:%s:%s' % (self.fragment_name,
+            digest.hexdigest())
+
+    def render(self, context):
+        if self.using is None:
+            alias = 'default'
+        else:
+            alias = self.using.resolve(context)
+        cache = cache_for_alias(alias)
+
+        key = self.get_cache_key(context)
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            if self.timeout is None:
+                cache.set(key, value)
+            else:
+                cache.set(key, value, int(self.timeout.resolve(context)))
+        return value
+
+
+@register.tag
+def mailcache(parser, token):
+    """
+    Caches the contents of the block, so that it is only rendered once for
+    all of the messages that share the same vary on values, such as a list of
+    the top stories in a weekly newsletter::
+
+        {% load mailviews %}
+        {% mailcache top_stories edition.pk locale timeout=3600 %}
+            {% for story in edition.top_stories %}...{% endfor %}
+        {% endmailcache %}
+
+    The first argument is the name of the cached fragment, and is followed by
+    any number of variables that the rendered content varies on.
+
+    The optional ``timeout`` argument is the number of seconds that the
+    rendered content is cached for (defaulting to the cache's default
+    timeout), and ``using`` is the alias of the cache to use (defaulting to
+    the ``default`` cache.)
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(
+            "'%s' tag requires at least 1 argument." % bits[0])
+
+    options = {}
+    vary_on = []
+    for bit in bits[2:]:
+        name, sep, value = bit.partition('=')
+        if sep and name in ('timeout', 'using'):
+            options[name] = parser.compile_filter(value)
+        else:
+            vary_on.append(parser.compile_filter(bit))
+
+    nodelist = parser.parse(('endmailcache',))
+    parser.delete_first_token()
+    return MailCacheNode(nodelist, bits[1], vary_on, **options)
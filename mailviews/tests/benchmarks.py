@@ -0,0 +1,203 @@
+"""
+Micro-benchmarks for the message rendering and preview paths.
+
+To run the benchmarks against your installed Django version, run::
+
+    python -m mailviews.tests.benchmarks
+
+Messages are sent using the in-memory email backend. Results are written as
+JSON (to standard output, unless an output file is provided) so that they can
+be compared between releases.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import mailviews.tests  # noqa (configures settings)
+
+import django
+from django.core import mail
+from django.template import Template
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from mailviews.messages import (TemplatedEmailMessageView,
+    TemplatedHTMLEmailMessageView)
+from mailviews.previews import Preview, PreviewSite
+from mailviews.tests.emails.previews import BasicHTMLPreview, BasicPreview
+from mailviews.tests.emails.views import BasicEmailMessageView
+
+
+#: The number of (unused) variables in the message context.
+CONTEXT_SIZES = (10, 100, 1000)
+
+#: The number of items rendered by the message templates.
+TEMPLATE_SIZES = (1, 10, 100)
+
+#: The number of registered previews.
+PREVIEW_COUNTS = (10, 100, 1000)
+
+
+class BenchmarkEmailMessageView(TemplatedEmailMessageView):
+    subject_template = Template('{{ subject }} ({{ items|length }} items)')
+    body_template = Template(
+        '{% for item in items %}'
+        '{{ forloop.counter }}. {{ item.title|title }}\n'
+        '{{ item.body|wordwrap:72 }}\n\n'
+        '{% endfor %}')
+
+
+class BenchmarkHTMLEmailMessageView(BenchmarkEmailMessageView,
+        TemplatedHTMLEmailMessageView):
+    html_body_template = Template(
+        '<html><head><style>'
+        'ul { margin: 0; padding: 0 } li.odd { background: #eee } '
+        'li h2 { font-size: 16px } li > p { color: #333 } a:hover { color: red }'
+        '</style></head><body><ul>'
+        '{% for item in items %}'
+        '<li class="{% cycle "odd" "even" %}">'
+        '<h2>{{ item.title|title }}</h2>{{ item.body|linebreaks }}'
+        '</li>'
+        '{% endfor %}'
+        '</ul></body></html>')
+
+
+def get_context(context_size, template_size):
+    context = dict(('key%s' % i, 'value %s' % i) for i in range(context_size))
+    context.update({
+        'subject': 'Benchmark message & subject',
+        'items': [{
+            'title': 'item <%s>' % i,
+            'body': 'Lorem ipsum dolor sit amet & consectetur. ' * 10,
+        } for i in range(template_size)],
+    })
+    return context
+
+
+def render_to_message(context_size, template_size):
+    view = BenchmarkEmailMessageView()
+    context = get_context(context_size, template_size)
+    return lambda: view.render_to_message(context)
+
+
+def render_html_to_message(context_size, template_size, inline_css=False):
+    view = BenchmarkHTMLEmailMessageView()
+    view.inline_css = inline_css
+    context = get_context(context_size, template_size)
+    return lambda: view.render_to_message(context)
+
+
+def send(context_size, template_size):
+    view = BenchmarkHTMLEmailMessageView()
+    context = get_context(context_size, template_size)
+
+    def send():
+        view.send(context, to=('ted@disqus.com',))
+        del mail.outbox[:]
+
+    return send
+
+
+def preview_detail_view(preview_class):
+    preview = preview_class(site=PreviewSite())
+    request = RequestFactory().get('/')
+    return lambda: preview.detail_view(request)
+
+
+def preview_site_iter(count):
+    site = PreviewSite()
+    for i in range(count):
+        # Spread the previews out over a handful of modules.
+        message_view = type('MessageView%s' % i, (BasicEmailMessageView,), {
+            '__module__': 'benchmark.module%s' % (i % 10),
+        })
+        site.register(type('Preview%s' % i, (Preview,), {
+            'message_view': message_view,
+        }))
+    return lambda: list(site)
+
+
+def grid(**parameters):
+    """
+    Returns a list of keyword argument dictionaries containing every
+    combination of the provided parameter values.
+    """
+    combinations = [{}]
+    for name, values in sorted(parameters.items()):
+        combinations = [dict(combination, **{name: value})
+            for combination in combinations for value in values]
+    return combinations
+
+
+#: A list of ``(name, factory, parameters)`` tuples. Each factory accepts the
+#: parameters as keyword arguments, returning the callable to be timed.
+BENCHMARKS = (
+    ('TemplatedEmailMessageView.render_to_message', render_to_message,
+        grid(context_size=CONTEXT_SIZES, template_size=TEMPLATE_SIZES)),
+    ('TemplatedHTMLEmailMessageView.render_to_message', render_html_to_message,
+        grid(context_size=CONTEXT_SIZES, template_size=TEMPLATE_SIZES) +
+        grid(context_size=CONTEXT_SIZES[:1], template_size=TEMPLATE_SIZES,
+            inline_css=(True,))),
+    ('TemplatedHTMLEmailMessageView.send', send,
+        grid(context_size=CONTEXT_SIZES[:1], template_size=TEMPLATE_SIZES)),
+    ('Preview.detail_view', preview_detail_view,
+        grid(preview_class=(BasicPreview, BasicHTMLPreview))),
+    ('PreviewSite.__iter__', preview_site_iter,
+        grid(count=PREVIEW_COUNTS)),
+)
+
+
+def run(pattern=None, number=100, repeat=3):
+    """
+    Runs all benchmarks with names containing ``pattern``, yielding a result
+    dictionary for each combination of benchmark parameters.
+    """
+    for name, factory, parameters in BENCHMARKS:
+        if pattern is not None and pattern not in name:
+            continue
+
+        for kwargs in parameters:
+            timings = timeit.repeat(factory(**kwargs), number=number,
+                repeat=repeat)
+            yield {
+                'name': name,
+                'parameters': dict((key, getattr(value, '__name__', value))
+                    for key, value in kwargs.items()),
+                'number': number,
+                'repeat': repeat,
+                'best': min(timings) / number,
+                'mean': sum(timings) / len(timings) / number,
+            }
+
+
+def __main__():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-k', dest='pattern', default=None,
+        help='only run benchmarks with names containing this value')
+    parser.add_argument('-n', '--number', type=int, default=100,
+        help='the number of calls made per timing (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='the number of timings per benchmark (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+        default=sys.stdout, help='the file to write results to')
+    options = parser.parse_args()
+
+    with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+        results = list(run(options.pattern, options.number, options.repeat))
+
+    json.dump({
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }, options.output, indent=2, sort_keys=True)
+    print(file=options.output)
+
+
+if __name__ == '__main__':
+    __main__()
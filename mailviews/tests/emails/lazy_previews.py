@@ -0,0 +1,11 @@
+"""
+Previews that are only registered by path, to test deferred registration.
+(This module should not be imported anywhere else.)
+"""
+from mailviews.previews import Preview
+from mailviews.tests.emails.views import BasicEmailMessageView
+
+
+class LazyPreview(Preview):
+    message_view = BasicEmailMessageView
+    verbose_name = 'Lazily Registered Message'
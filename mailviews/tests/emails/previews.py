@@ -41,6 +41,10 @@ class CustomizablePreview(Preview):
     verbose_name = 'Basic Message, with Form'
     description = 'A basic text email message, but customizable.'
     form_class = CustomizationForm
+    sample_data = {
+        'subject': 'Sample subject',
+        'content': 'Sample content',
+    }
 
 
 site.register(BasicPreview)
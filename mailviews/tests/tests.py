@@ -1,17 +1,42 @@
+import base64
 import functools
 import os
+import re
+import shutil
+import smtplib
+import sys
+import tempfile
+import threading
 
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.core import mail
+from django.core.mail.backends import locmem
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
-from django.template import Context, Template, TemplateDoesNotExist
+from django.template import (Context, Template, TemplateDoesNotExist,
+    TemplateSyntaxError)
 from django.template.loader import get_template
+from django.utils.six import BytesIO, StringIO
 
-from mailviews.messages import (TemplatedEmailMessageView,
+from mailviews.messages import (PRIORITY_BULK, PRIORITY_HIGH,
+                                SerializedEmailMessage,
+                                TemplatedEmailMessageView,
                                 TemplatedHTMLEmailMessageView)
-from mailviews.previews import URL_NAMESPACE
+from mailviews.attachments import CHUNK_SIZE, FileAttachment
+from mailviews.backends import smtp
+from mailviews.cache import LRUCache
+from mailviews.campaigns import Campaign, get_recipient_key, get_shard
+from mailviews.css import Stylesheet, inline_css
+from mailviews.outbox import Outbox, get_outbox
+from mailviews.pool import ConnectionPool, PoolTimeout
+from mailviews.previews import (URL_NAMESPACE, PartSize, PreviewSite,
+    autodiscover, measure_message)
+from mailviews.scheduler import (PriorityScheduler, SendScheduler,
+    TokenBucket)
+from mailviews.signals import phase_timed
 from mailviews.tests.emails.views import (BasicEmailMessageView,
                                           BasicHTMLEmailMessageView)
 from mailviews.tests.emails.previews import (BasicPreview,
@@ -36,6 +61,43 @@ using_test_templates = override_settings(
 )
 
 
+class CountingEmailBackend(locmem.EmailBackend):
+    """
+    An in-memory email backend that records how many times it was opened.
+    """
+    opened = 0
+
+    def open(self):
+        self.opened += 1
+        return super(CountingEmailBackend, self).open()
+
+
+class RefusingEmailBackend(locmem.EmailBackend):
+    """
+    An in-memory email backend that refuses any recipient at
+    ``refused.disqus.com``.
+    """
+    def send_messages(self, messages):
+        for message in messages:
+            refused = dict((recipient, (550, b'Refused'))
+                for recipient in message.recipients()
+                if recipient.endswith('@refused.disqus.com'))
+            if refused:
+                raise smtplib.SMTPRecipientsRefused(refused)
+        return super(RefusingEmailBackend, self).send_messages(messages)
+
+
+class PickleCounter(object):
+    """
+    A context value that records how many times it has been pickled.
+    """
+    pickled = 0
+
+    def __getstate__(self):
+        type(self).pickled += 1
+        return {}
+
+
 class EmailMessageViewTestCase(TestCase):
     def run(self, *args, **kwargs):
         with using_test_templates:
@@ -108,6 +170,35 @@ class TemplatedEmailMessageViewTestCase(EmailMessageViewTestCase):
         self.message.subject_template_name = template
         self.assertEqual(self.render_subject(), self.subject)
 
+    def test_template_name_cache(self):
+        self.message.subject_template_name = 'subject.txt'
+        template = self.message.subject_template
+
+        other = self.message_class()
+        other.subject_template_name = 'subject.txt'
+        self.assertTrue(other.subject_template is template)
+
+        self.message_class.clear_template_cache()
+        self.assertFalse(self.message.subject_template is template)
+
+    def test_template_name_cache_disabled_when_debugging(self):
+        self.message.subject_template_name = 'subject.txt'
+        with override_settings(DEBUG=True):
+            template = self.message.subject_template
+            self.assertFalse(self.message.subject_template is template)
+
+    def test_subject_template_name_unescaped(self):
+        self.message.subject_template_name = 'subject.txt'
+        context = Context({'subject': 'this & that'})
+        self.assertEqual(self.message.render_subject(context), 'this & that')
+        self.assertTrue(context.autoescape)
+
+    def test_uncompiled_text_templates(self):
+        self.message.compile_text_templates = False
+        self.message.subject_template = Template('{{ subject }}')
+        context = Context({'subject': 'this & that'})
+        self.assertEqual(self.message.render_subject(context), 'this & that')
+
     def test_subject_template(self):
         self.message.subject_template = self.subject_template
         self.assertEqual(self.render_subject(), self.subject)
@@ -133,6 +224,11 @@ class TemplatedEmailMessageViewTestCase(EmailMessageViewTestCase):
         self.message.body_template = self.body_template
         self.assertEqual(self.render_body(), self.body)
 
+    def test_body_template_unescaped(self):
+        self.message.body_template = Template('{{ body }} {% autoescape on %}{{ body }}{% endautoescape %}')
+        self.assertEqual(self.message.render_body(Context({'body': '<b>'})),
+            '<b> &lt;b&gt;')
+
     def test_render_to_message(self):
         self.add_templates_to_message()
         message = self.message.render_to_message(self.context_dict)
@@ -144,6 +240,166 @@ class TemplatedEmailMessageViewTestCase(EmailMessageViewTestCase):
         self.message.send(self.context_dict, to=('ted@disqus.com',))
         self.assertOutboxLengthEquals(1)
 
+    def test_render_to_serialized_message(self):
+        self.add_templates_to_message()
+        message = self.message.render_to_serialized_message(self.context_dict,
+            to=('ted@disqus.com',), bcc=('bcc@disqus.com',))
+        self.assertEqual(message.recipients(), ['ted@disqus.com', 'bcc@disqus.com'])
+        self.assertIn(b'Subject: subject', message.content)
+        self.assertEqual(message.message()['Subject'], 'subject')
+
+        self.assertEqual(message.send(), 1)
+        self.assertOutboxLengthEquals(1)
+        self.assertTrue(mail.outbox[0] is message)
+
+    def test_render_to_bytes(self):
+        self.add_templates_to_message()
+        content = self.message.render_to_bytes(self.context_dict)
+        self.assertTrue(isinstance(content, bytes))
+        self.assertIn(b'\r\n\r\nbody', content)
+        self.assertFalse(re.search(b'[^\r]\n', content))
+
+    def test_send_many(self):
+        self.add_templates_to_message()
+        connection = CountingEmailBackend()
+        results = self.message.send_many((
+            {'extra_context': {'subject': 'first'}, 'to': ('a@disqus.com',)},
+            {'extra_context': {'subject': 'second'}, 'to': ('b@disqus.com',)},
+        ), connection=connection, from_email='ted@disqus.com')
+
+        self.assertEqual(results, [1, 1])
+        self.assertEqual(connection.opened, 1)
+        self.assertOutboxLengthEquals(2)
+        self.assertEqual([m.subject for m in mail.outbox], ['first', 'second'])
+        self.assertEqual(mail.outbox[1].to, ['b@disqus.com'])
+        self.assertEqual(mail.outbox[1].from_email, 'ted@disqus.com')
+
+    def test_send_many_failure(self):
+        self.add_templates_to_message()
+        items = (
+            {'to': ('a@disqus.com',)},
+            {'to': ('b@refused.disqus.com',)},
+            {'to': ('c@disqus.com',)},
+        )
+
+        results = self.message.send_many(items,
+            connection=RefusingEmailBackend())
+        self.assertEqual(results, [1, 0, 1])
+        self.assertEqual([m.to for m in mail.outbox],
+            [['a@disqus.com'], ['c@disqus.com']])
+
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+            self.message.send_many, items, connection=RefusingEmailBackend(),
+            raise_errors=True)
+
+    def test_iter_messages(self):
+        self.add_templates_to_message()
+        consumed = []
+
+        def items():
+            for subject in ('first', 'second'):
+                consumed.append(subject)
+                yield {'extra_context': {'subject': subject}}
+
+        messages = self.message.iter_messages(items(), to=('ted@disqus.com',))
+        self.assertEqual(consumed, [])
+
+        message = next(messages)
+        self.assertEqual(message.subject, 'first')
+        self.assertEqual(message.to, ['ted@disqus.com'])
+        self.assertEqual(consumed, ['first'])
+
+        self.assertEqual([m.subject for m in messages], ['second'])
+
+    def test_render_many(self):
+        self.add_templates_to_message()
+        self.message.headers['Reply-To'] = 'ted@disqus.com'
+        subjects = ['subject %s' % i for i in range(5)]
+        messages = self.message.render_many(
+            ({'extra_context': dict(self.context_dict, subject=subject),
+              'to': ('%s@disqus.com' % i,)}
+                for i, subject in enumerate(subjects)),
+            workers=2)
+
+        self.assertEqual([m.subject for m in messages], subjects)
+        self.assertEqual(messages[3].to, ['3@disqus.com'])
+        self.assertEqual(messages[3].body, self.body)
+        self.assertEqual(messages[3].extra_headers['Reply-To'], 'ted@disqus.com')
+        self.assertTrue(isinstance(messages[3], self.message.message_class))
+
+    def test_base_context(self):
+        self.add_templates_to_message()
+        calls = []
+
+        def get_base_context_data():
+            calls.append(True)
+            return {'subject': 'base subject', 'body': 'base body'}
+
+        self.message.get_base_context_data = get_base_context_data
+
+        message = self.message.render_to_message()
+        self.assertEqual(message.subject, 'base subject')
+        self.assertEqual(message.body, 'base body')
+
+        message = self.message.render_to_message({'subject': 'overlay'})
+        self.assertEqual(message.subject, 'overlay')
+        self.assertEqual(message.body, 'base body')
+
+        context = self.message.get_context_data()
+        context['body'] = 'changed'
+        self.assertEqual(self.message.base_context['body'], 'base body')
+
+        self.assertEqual(len(calls), 1)
+
+    def test_render_cache(self):
+        self.add_templates_to_message()
+        self.message.render_cache = LRUCache(max_size=1024)
+        calls = []
+        render_parts = self.message.render_parts
+
+        def counting_render_parts(context):
+            calls.append(context)
+            return render_parts(context)
+
+        self.message.render_parts = counting_render_parts
+
+        self.message.headers['Reply-To'] = 'first@disqus.com'
+        first = self.message.render_to_message(self.context_dict)
+        self.message.headers['Reply-To'] = 'second@disqus.com'
+        second = self.message.render_to_message(self.context_dict)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.subject, first.subject)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(second.extra_headers['Reply-To'], 'second@disqus.com')
+
+        other = self.message.render_to_message(dict(self.context_dict,
+            subject='other'))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(other.subject, 'other')
+
+    def test_render_cache_key_base_context(self):
+        PickleCounter.pickled = 0
+        self.message.get_base_context_data = lambda: {
+            'stories': PickleCounter(),
+        }
+
+        keys = [self.message.get_render_cache_key(
+            self.message.get_context_data(user=user))
+            for user in ('a', 'b', 'a')]
+        self.assertEqual(PickleCounter.pickled, 1)
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], keys[2])
+
+        other = self.message_class()
+        other.get_base_context_data = lambda: {'stories': 'other'}
+        self.assertNotEqual(other.get_render_cache_key(
+            other.get_context_data(user='a')), keys[0])
+
+    def test_render_cache_unpicklable_context(self):
+        self.add_templates_to_message()
+        context = self.message.get_context_data(callback=lambda: None)
+        self.assertEqual(self.message.get_render_cache_key(context), None)
+
     def test_custom_headers(self):
         self.add_templates_to_message()
         address = 'ted@disqus.com'
@@ -205,6 +461,17 @@ class TemplatedHTMLEmailMessageViewTestCase(TemplatedEmailMessageViewTestCase):
         self.message.html_body_template = self.html_body_template
         self.assertEqual(self.render_html_body(), self.html_body)
 
+    def test_html_body_escaped(self):
+        self.add_templates_to_message()
+        message = self.message.render_to_message({
+            'subject': 'this & that',
+            'body': 'this & that',
+            'html': 'this & that',
+        })
+        self.assertEqual(message.subject, 'this & that')
+        self.assertEqual(message.body, 'this & that')
+        self.assertEqual(message.alternatives[0][0], 'this &amp; that')
+
     def test_render_to_message(self):
         self.add_templates_to_message()
         message = self.message.render_to_message(self.context_dict)
@@ -212,12 +479,612 @@ class TemplatedHTMLEmailMessageViewTestCase(TemplatedEmailMessageViewTestCase):
         self.assertEqual(message.body, self.body)
         self.assertEqual(message.alternatives, [(self.html_body, 'text/html')])
 
+    def test_render_to_message_builds_context_once(self):
+        self.add_templates_to_message()
+        calls = []
+        get_context_data = self.message.get_context_data
+
+        def counting_get_context_data(**kwargs):
+            calls.append(kwargs)
+            return get_context_data(**kwargs)
+
+        self.message.get_context_data = counting_get_context_data
+        self.message.render_to_message(self.context_dict)
+        self.assertEqual(len(calls), 1)
+
+    def test_render_parts(self):
+        self.add_templates_to_message()
+        self.message.headers['Reply-To'] = 'ted@disqus.com'
+        parts = self.message.render_parts(self.context)
+        self.assertEqual(parts.subject, self.subject)
+        self.assertEqual(parts.body, self.body)
+        self.assertEqual(parts.alternatives, [(self.html_body, 'text/html')])
+        self.assertEqual(parts.headers, {'Reply-To': 'ted@disqus.com'})
+
+    def test_phase_timed(self):
+        self.add_templates_to_message()
+        timings = []
+
+        def receiver(sender, view, phase, duration, **kwargs):
+            self.assertTrue(view is self.message)
+            self.assertTrue(duration >= 0)
+            timings.append((sender, phase))
+
+        phase_timed.connect(receiver)
+        try:
+            self.message.send(self.context_dict, to=('ted@disqus.com',))
+        finally:
+            phase_timed.disconnect(receiver)
+
+        self.assertEqual(timings, [(self.message_class, phase) for phase in
+            ('context', 'subject', 'body', 'html_body', 'message', 'send')])
+
+    def test_inline_css(self):
+        self.add_templates_to_message()
+        self.message.inline_css = True
+        self.message.html_body_template = Template(
+            '<style>p { color: red }</style><p>{{ html }}</p>')
+        message = self.message.render_to_message(self.context_dict)
+        self.assertEqual(message.alternatives[0][0],
+            '<p style="color: red">%s</p>' % self.html_body)
+
+    def test_render_many_alternatives(self):
+        self.add_templates_to_message()
+        messages = self.message.render_many([
+            {'extra_context': self.context_dict},
+        ], workers=1)
+        self.assertEqual(messages[0].alternatives, [(self.html_body, 'text/html')])
+
     def test_send(self):
         self.add_templates_to_message()
         self.message.send(self.context_dict, to=('ted@disqus.com',))
         self.assertOutboxLengthEquals(1)
 
 
+class RecordingSMTPConnection(object):
+    """
+    Records the messages passed to ``sendmail`` in place of an SMTP client.
+    """
+    disconnected = False
+
+    def __init__(self):
+        self.sent = []
+
+    def noop(self):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected()
+        return (250, b'OK')
+
+    def sendmail(self, from_email, recipients, content):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected()
+        self.sent.append((from_email, recipients, content))
+
+
+class PooledEmailBackend(locmem.EmailBackend):
+    """
+    An in-memory email backend with a fake SMTP connection, which records how
+    many connections have been opened.
+    """
+    opened = 0
+
+    def open(self):
+        type(self).opened += 1
+        self.connection = RecordingSMTPConnection()
+        return True
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, messages):
+        for message in messages:
+            self.connection.sendmail(message.from_email, message.recipients(),
+                message.message().as_string())
+        return super(PooledEmailBackend, self).send_messages(messages)
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        PooledEmailBackend.opened = 0
+        self.pool = ConnectionPool('mailviews.tests.tests.PooledEmailBackend',
+            max_size=2)
+
+    def test_connection_reuse(self):
+        class PooledMessageView(BasicEmailMessageView):
+            connection_pool = self.pool
+
+        view = PooledMessageView('subject', 'content')
+        for i in range(3):
+            self.assertEqual(view.send(to=('ted@disqus.com',)), 1)
+        self.assertEqual(view.send_many([{'to': ('ted@disqus.com',)}]), [1])
+
+        self.assertEqual(PooledEmailBackend.opened, 1)
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_max_size(self):
+        connections = [self.pool.acquire(), self.pool.acquire()]
+        self.assertRaises(PoolTimeout, self.pool.acquire, timeout=0)
+
+        self.pool.release(connections[0])
+        self.assertTrue(self.pool.acquire(timeout=0) is connections[0])
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.assertFalse(self.pool.acquire() is connection)
+        self.assertTrue(connection.connection is None)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_health_check(self):
+        self.pool.check_interval = 0
+        connection = self.pool.acquire()
+        self.pool.release(connection)
+        self.assertTrue(self.pool.acquire() is connection)
+        self.pool.release(connection)
+
+        connection.connection.disconnected = True
+        self.assertFalse(self.pool.acquire() is connection)
+        self.assertEqual(PooledEmailBackend.opened, 2)
+
+    def test_reconnect(self):
+        connection = self.pool.acquire()
+        connection.connection.disconnected = True
+        self.pool.release(connection)
+
+        message = mail.EmailMessage('subject', 'body', to=('ted@disqus.com',))
+        self.assertEqual(self.pool.send_messages([message]), 1)
+        self.assertEqual(PooledEmailBackend.opened, 2)
+        self.assertEqual(len(self.pool), 1)
+
+
+class TokenBucketTestCase(TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(rate=10)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_capacity(self):
+        bucket = TokenBucket(rate=10, capacity=3)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+
+
+class SendSchedulerTestCase(TestCase):
+    def test_send(self):
+        scheduler = SendScheduler(connections=3, rate=200)
+        view = BasicEmailMessageView('subject', 'content')
+        report = scheduler.send(view, ({'to': ('%s@disqus.com' % i,)}
+            for i in range(20)), from_email='ted@disqus.com')
+
+        self.assertEqual(report.results, [1] * 20)
+        self.assertEqual(len(mail.outbox), 20)
+        self.assertEqual(set(m.to[0] for m in mail.outbox),
+            set('%s@disqus.com' % i for i in range(20)))
+
+        # The first message is sent immediately, and the rest at the rate.
+        self.assertTrue(report.elapsed >= 19 / 200.0)
+
+    def test_failure(self):
+        scheduler = SendScheduler(connections=2)
+        view = BasicEmailMessageView('subject', 'content')
+        report = scheduler.send(view, [
+            {'to': ('a@disqus.com',)},
+            {'to': ('b@disqus.com',), 'invalid': True},
+            {'to': ('c@disqus.com',)},
+        ])
+        self.assertEqual(report.results, [1, 0, 1])
+        self.assertEqual((report.sent, report.failed), (2, 1))
+
+    def test_connection_failure(self):
+        scheduler = SendScheduler(connections=2,
+            backend='mailviews.tests.tests.UnavailableEmailBackend')
+        view = BasicEmailMessageView('subject', 'content')
+        items = [{'to': ('%s@disqus.com' % i,)} for i in range(3)]
+
+        UnavailableEmailBackend.failures = 1
+        report = scheduler.send(view, items)
+        self.assertEqual(report.results, [1, 1, 1])
+        self.assertTrue(isinstance(report.error, smtplib.SMTPConnectError))
+
+        UnavailableEmailBackend.failures = 2
+        report = scheduler.send(view, items)
+        self.assertEqual(report.results, [])
+        self.assertTrue(isinstance(report.error, smtplib.SMTPConnectError))
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class UnavailableEmailBackend(locmem.EmailBackend):
+    """
+    An in-memory email backend that fails to open a number of connections
+    before it opens successfully.
+    """
+    failures = 0
+
+    def open(self):
+        if UnavailableEmailBackend.failures:
+            UnavailableEmailBackend.failures -= 1
+            raise smtplib.SMTPConnectError(421, 'Unavailable')
+        return super(UnavailableEmailBackend, self).open()
+
+
+class BlockingEmailBackend(locmem.EmailBackend):
+    """
+    An in-memory email backend that waits for an event to be set before it
+    sends messages.
+    """
+    sending = threading.Event()
+    event = threading.Event()
+
+    def send_messages(self, messages):
+        self.sending.set()
+        self.event.wait()
+        return super(BlockingEmailBackend, self).send_messages(messages)
+
+
+class PrioritySchedulerTestCase(TestCase):
+    def test_priority(self):
+        class BulkMessageView(BasicEmailMessageView):
+            priority = PRIORITY_BULK
+
+        class HighPriorityMessageView(BasicEmailMessageView):
+            priority = PRIORITY_HIGH
+
+        BlockingEmailBackend.sending.clear()
+        BlockingEmailBackend.event.clear()
+        scheduler = PriorityScheduler(
+            backend='mailviews.tests.tests.BlockingEmailBackend')
+        with scheduler:
+            scheduler.submit_many(BulkMessageView('bulk', 'content'),
+                [{'to': ('%s@disqus.com' % i,)} for i in range(3)])
+            BlockingEmailBackend.sending.wait()
+            scheduler.submit(HighPriorityMessageView('high', 'content'),
+                to=('ted@disqus.com',))
+            BlockingEmailBackend.event.set()
+
+        # The first bulk message was already being sent.
+        self.assertEqual([m.subject for m in mail.outbox],
+            ['bulk', 'high', 'bulk', 'bulk'])
+        self.assertEqual(scheduler.stats[PRIORITY_HIGH].sent, 1)
+        self.assertEqual(scheduler.stats[PRIORITY_BULK].sent, 3)
+        self.assertTrue(scheduler.stats[PRIORITY_BULK].max_latency >=
+            scheduler.stats[PRIORITY_HIGH].max_latency)
+
+    def test_failing_items(self):
+        def items():
+            yield {'to': ('a@disqus.com',)}
+            raise RuntimeError('The database is unavailable.')
+
+        scheduler = PriorityScheduler(connections=1)
+        with scheduler:
+            scheduler.submit_many(BasicEmailMessageView('bulk', 'content'),
+                items(), priority=PRIORITY_BULK)
+            scheduler.submit(BasicEmailMessageView('high', 'content'),
+                priority=PRIORITY_HIGH, to=('ted@disqus.com',))
+
+        self.assertEqual(sorted(m.subject for m in mail.outbox),
+            ['bulk', 'high'])
+        self.assertEqual((scheduler.stats[PRIORITY_BULK].sent,
+            scheduler.stats[PRIORITY_BULK].failed), (1, 1))
+        self.assertEqual(scheduler.stats[PRIORITY_HIGH].sent, 1)
+
+    def test_slow_items(self):
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def items():
+            yield {'to': ('a@disqus.com',)}
+            fetching.set()
+            release.wait(5)
+            yield {'to': ('b@disqus.com',)}
+
+        scheduler = PriorityScheduler(connections=2)
+        with scheduler:
+            try:
+                scheduler.submit_many(BasicEmailMessageView('bulk', 'content'),
+                    items(), priority=PRIORITY_BULK)
+                fetching.wait(5)
+                self.assertTrue(fetching.is_set())
+
+                # Submitting doesn't wait for the slow iterable.
+                thread = threading.Thread(target=scheduler.submit,
+                    args=(BasicEmailMessageView('high', 'content'),),
+                    kwargs={'priority': PRIORITY_HIGH,
+                        'to': ('ted@disqus.com',)})
+                thread.start()
+                thread.join(1)
+                self.assertFalse(thread.is_alive())
+            finally:
+                release.set()
+
+        self.assertEqual(sorted(m.subject for m in mail.outbox),
+            ['bulk', 'bulk', 'high'])
+        self.assertEqual(scheduler.stats[PRIORITY_BULK].sent, 2)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_submit_after_stop(self):
+        scheduler = PriorityScheduler()
+        scheduler.start()
+        scheduler.stop()
+        self.assertRaises(RuntimeError, scheduler.submit,
+            BasicEmailMessageView('subject', 'content'))
+
+
+class CrashingEmailBackend(locmem.EmailBackend):
+    """
+    An in-memory email backend that stops the process (by raising
+    ``KeyboardInterrupt``) once it has sent a number of messages.
+    """
+    limit = None
+
+    def send_messages(self, messages):
+        if self.limit is not None and len(mail.outbox) >= self.limit:
+            raise KeyboardInterrupt
+        return super(CrashingEmailBackend, self).send_messages(messages)
+
+
+class CampaignTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.view = BasicEmailMessageView('subject', 'content')
+        self.items = [{'to': ('%s@disqus.com' % i,)} for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_shard(self):
+        self.assertEqual(get_shard('ted@disqus.com', 4), 3)
+        shards = [get_shard(get_recipient_key(item), 4) for item in self.items]
+        self.assertEqual(sorted(set(shards)), [0, 1, 2, 3])
+
+    def test_shards(self):
+        reports = [Campaign('test', self.view, shards=3, shard=shard,
+            directory=self.directory).run(self.items) for shard in range(3)]
+
+        self.assertEqual(sum(report.sent for report in reports), 20)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+            sorted(item['to'][0] for item in self.items))
+
+    def test_resume(self):
+        campaign = Campaign('test', self.view, directory=self.directory)
+        connection = CrashingEmailBackend()
+        connection.limit = 5
+        self.assertRaises(KeyboardInterrupt, campaign.run, self.items,
+            connection=connection)
+        self.assertEqual(len(mail.outbox), 5)
+
+        report = campaign.run(self.items)
+        self.assertEqual((report.sent, report.skipped), (15, 5))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+            sorted(item['to'][0] for item in self.items))
+        self.assertEqual(campaign.get_checkpoint().counts(), (20, 0))
+
+
+class SMTPEmailBackendTestCase(TestCase):
+    def test_send_serialized_message(self):
+        message = SerializedEmailMessage(mail.EmailMessage('subject', 'body',
+            'ted@disqus.com', ('a@disqus.com',), cc=('b@disqus.com',)))
+
+        backend = smtp.EmailBackend()
+        backend.connection = RecordingSMTPConnection()
+        self.assertEqual(backend.send_messages([message]), 1)
+        self.assertEqual(backend.connection.sent, [('ted@disqus.com',
+            ['a@disqus.com', 'b@disqus.com'], message.content)])
+
+    def test_crlf_line_endings(self):
+        message = mail.EmailMessage('subject', 'first\nsecond\r\nthird\n',
+            'ted@disqus.com', ('a@disqus.com',))
+        message.attach(FileAttachment(BytesIO(b'x' * CHUNK_SIZE * 2),
+            'data.bin'))
+
+        backend = smtp.EmailBackend()
+        backend.connection = RecordingSMTPConnection()
+        backend.send_messages([SerializedEmailMessage(message)])
+
+        content = backend.connection.sent[0][2]
+        self.assertIn(b'\r\n\r\nfirst\r\nsecond\r\nthird\r\n', content)
+        self.assertFalse(re.search(b'[^\r]\n|\r[^\n]', content))
+        self.assertEqual(SerializedEmailMessage(message).message()['Subject'],
+            'subject')
+
+
+class FileAttachmentTestCase(TestCase):
+    def setUp(self):
+        # Larger than a single chunk, to ensure chunks are encoded correctly.
+        self.content = os.urandom(CHUNK_SIZE * 2 + 1000)
+        fd, self.path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_path(self):
+        attachment = FileAttachment(self.path)
+        self.assertEqual(attachment.get_content_type(), 'application/pdf')
+        self.assertEqual(attachment.get_filename(), os.path.basename(self.path))
+        self.assertEqual(base64.b64decode(attachment.get_payload()), self.content)
+        self.assertEqual(attachment.get_payload(decode=True), self.content)
+
+    def test_file_object(self):
+        attachment = FileAttachment(BytesIO(self.content), filename='report')
+        self.assertEqual(attachment.get_content_type(), 'application/octet-stream')
+        for i in range(2):
+            self.assertEqual(attachment.get_payload(decode=True), self.content)
+
+    def test_encoded_part_cache(self):
+        cache = LRUCache(max_size=CHUNK_SIZE * 4)
+        attachment = FileAttachment(self.path)
+        attachment.cache = cache
+        encoded = attachment.encode()
+        self.assertEqual(len(cache), 1)
+
+        # Attachments with the same content share the encoded content.
+        other = FileAttachment(BytesIO(self.content), filename='other.pdf')
+        other.cache = cache
+        self.assertTrue(other.encode() is encoded)
+
+        other = FileAttachment(BytesIO(b'other'), filename='other.pdf')
+        other.cache = cache
+        self.assertEqual(base64.b64decode(other.encode()), b'other')
+        self.assertEqual(len(cache), 2)
+
+    def test_content_id(self):
+        attachment = FileAttachment(self.path, content_id='logo')
+        self.assertEqual(attachment['Content-ID'], '<logo>')
+        self.assertTrue(attachment['Content-Disposition'].startswith('inline'))
+
+    def test_view_attachments(self):
+        class AttachmentMessageView(BasicEmailMessageView):
+            attachments = (self.path,)
+
+        view = AttachmentMessageView('subject', 'content')
+        message = view.render_to_serialized_message(to=('ted@disqus.com',))
+        parts = list(message.message().walk())
+        self.assertEqual(parts[-1].get_filename(), os.path.basename(self.path))
+        self.assertEqual(parts[-1].get_payload(decode=True), self.content)
+
+
+class LRUCacheTestCase(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')  # 'b' is now the oldest
+
+        cache.set('c', 'cccc')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.size, 8)
+
+    def test_oversized_value(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 'aaa')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_timeout(self):
+        cache = LRUCache(max_size=10)
+        cache.set('a', 'a', timeout=-1)
+        cache.set('b', 'b', timeout=60)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'b')
+        self.assertEqual(cache.size, 1)
+
+
+class MailCacheTagTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def render(self, source, **context):
+        return Template('{% load mailviews %}' + source).render(Context(context))
+
+    def test_mailcache(self):
+        source = '{% mailcache stories locale %}{{ value }}{% endmailcache %}'
+        self.assertEqual(self.render(source, locale='en', value='a'), 'a')
+        self.assertEqual(self.render(source, locale='en', value='b'), 'a')
+        self.assertEqual(self.render(source, locale='fr', value='c'), 'c')
+
+    def test_mailcache_autoescape(self):
+        source = '{% mailcache stories %}{{ value }}{% endmailcache %}'
+        self.assertEqual(self.render(source, value='&'), '&amp;')
+        rendered = Template('{% load mailviews %}' + source).render(
+            Context({'value': '&'}, autoescape=False))
+        self.assertEqual(rendered, '&')
+
+    def test_mailcache_timeout(self):
+        source = '{% mailcache stories timeout=0 %}{{ value }}{% endmailcache %}'
+        self.assertEqual(self.render(source, value='a'), 'a')
+        self.assertEqual(self.render(source, value='b'), 'b')
+
+    def test_mailcache_requires_name(self):
+        self.assertRaises(TemplateSyntaxError, Template,
+            '{% load mailviews %}{% mailcache %}{% endmailcache %}')
+
+
+class InlineCSSTestCase(TestCase):
+    def test_selectors(self):
+        html = inline_css(
+            '<style>'
+            'p { color: red; margin: 0 }'
+            '.note { color: blue }'
+            'div > p.note { font-weight: bold }'
+            '#main em { font-style: normal }'
+            '</style>'
+            '<div id="main"><p class="note">a <em>b</em></p><span><p class="note">c</p></span></div>')
+        self.assertEqual(html,
+            '<div id="main">'
+            '<p class="note" style="color: blue; margin: 0; font-weight: bold">'
+            'a <em style="font-style: normal">b</em></p>'
+            '<span><p class="note" style="color: blue; margin: 0">c</p></span>'
+            '</div>')
+
+    def test_inline_style_precedence(self):
+        html = inline_css(
+            '<style>p { color: red; margin: 0 !important }</style>'
+            '<p style="color: blue; margin: 1px">a</p>')
+        self.assertEqual(html, '<p style="color: blue; margin: 0 !important">a</p>')
+
+    def test_void_elements(self):
+        html = inline_css(
+            '<style>p img { border: 0 } div img { width: 1px }</style>'
+            '<p><img src="a.png"><br/></p><div><img src="b.png" /></div>')
+        self.assertEqual(html,
+            '<p><img src="a.png" style="border: 0"><br/></p>'
+            '<div><img src="b.png" style="width: 1px" /></div>')
+
+    def test_semicolons_in_values(self):
+        html = inline_css(
+            '<style>'
+            'p { background: url(data:image/png;base64,AAA); color: red }'
+            'a { font-family: "a;b", serif }'
+            'em { background: url(data:image/png;base64,AAA }'
+            '</style>'
+            '<p>a</p><a>b</a><em>c</em>')
+        self.assertEqual(html,
+            '<style>\nem { background: url(data:image/png;base64,AAA }\n'
+            '</style>'
+            '<p style="background: url(data:image/png;base64,AAA); '
+            'color: red">a</p>'
+            '<a style="font-family: &quot;a;b&quot;, serif">b</a><em>c</em>')
+
+    def test_conditional_comments(self):
+        conditional = ('<!--[if mso]><style>p { font-family: Arial }</style>'
+            '<![endif]-->')
+        html = inline_css('<style>p { color: red }</style>' + conditional +
+            '<p>a</p>')
+        self.assertEqual(html, conditional + '<p style="color: red">a</p>')
+        self.assertEqual(inline_css(conditional + '<p>a</p>'),
+            conditional + '<p>a</p>')
+
+    def test_remainder(self):
+        html = inline_css(
+            '<style type="text/css">'
+            'a, a:hover { color: red }'
+            '@media (max-width: 600px) { a { color: blue } }'
+            '</style>'
+            '<style media="print">a { display: none }</style>'
+            '<a href="#">a</a>')
+        self.assertEqual(html,
+            '<style type="text/css">\n'
+            'a:hover { color: red }\n'
+            '@media (max-width: 600px) { a { color: blue } }\n'
+            '</style>'
+            '<style media="print">a { display: none }</style>'
+            '<a href="#" style="color: red">a</a>')
+
+    def test_no_stylesheet(self):
+        html = '<p>a</p>'
+        self.assertTrue(inline_css(html) is html)
+
+    def test_stylesheet_index(self):
+        stylesheet = Stylesheet('#a { color: red } .b.c { color: red } * { color: red }')
+        self.assertEqual(sorted(stylesheet.index), [('class', 'b'), ('id', 'a')])
+        self.assertEqual(len(stylesheet.universal), 1)
+
+
 class SplitDocstringTestCase(TestCase):
     def test_split_docstring(self):
         header, body = split_docstring(split_docstring)
@@ -231,6 +1098,222 @@ class SplitDocstringTestCase(TestCase):
         self.assertEqual(header, "Does a thing.")
 
 
+class PreviewSiteIndexTestCase(TestCase):
+    def test_register_path(self):
+        site = PreviewSite()
+        path = 'mailviews.tests.emails.lazy_previews'
+        sys.modules.pop(path, None)
+        site.register('%s.LazyPreview' % path)
+        self.assertFalse(path in sys.modules)
+
+        (module, previews), = list(site)
+        self.assertTrue(path in sys.modules)
+        self.assertEqual(module, BasicEmailMessageView.__module__)
+        self.assertEqual([type(preview).__name__ for preview in previews],
+            ['LazyPreview'])
+
+    def test_register_path_failure(self):
+        site = PreviewSite()
+        site.register('mailviews.tests.emails.lazy_previews.MissingPreview')
+        self.assertRaises(AttributeError, list, site)
+        self.assertRaises(AttributeError, list, site)
+
+    def test_index_cached(self):
+        site = PreviewSite()
+        site.register(BasicPreview)
+        index = site.index
+        self.assertTrue(site.index is index)
+
+        site.register(BasicHTMLPreview)
+        self.assertFalse(site.index is index)
+        self.assertEqual(len(site.index[0].previews), 2)
+
+
+class AutodiscoverTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.directory, 'previews.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_manifest(self):
+        autodiscover(manifest=self.manifest)
+        with open(self.manifest) as f:
+            self.assertEqual(f.read().split(), ['mailviews.tests.emails.previews'])
+
+        with open(self.manifest, 'w') as f:
+            f.write('mailviews.tests.emails.lazy_previews\n')
+        autodiscover(manifest=self.manifest)
+        self.assertTrue('mailviews.tests.emails.lazy_previews' in sys.modules)
+
+    def test_lazy(self):
+        site = PreviewSite()
+        calls = []
+        site.defer(lambda: calls.append(site.register(BasicPreview)))
+        self.assertEqual(calls, [])
+
+        self.assertEqual(len(list(site)), 1)
+        self.assertEqual(len(calls), 1)
+        list(site)
+        self.assertEqual(len(calls), 1)
+
+    def test_lazy_failure(self):
+        site = PreviewSite()
+        calls = []
+
+        def register():
+            calls.append(None)
+            if len(calls) == 1:
+                raise ImportError('Temporary failure.')
+            site.register(BasicPreview)
+
+        site.defer(register)
+        self.assertRaises(ImportError, list, site)
+        self.assertEqual(len(list(site)), 1)
+        self.assertEqual(len(calls), 2)
+
+
+class MessageSizeTestCase(TestCase):
+    def test_measure_message(self):
+        message = mail.EmailMultiAlternatives(subject='subject', body=u'body \u2603')
+        message.attach_alternative('<p>html</p>', 'text/html')
+        message.attach('report.csv', 'a,b', 'text/csv')
+
+        sizes = dict(measure_message(message))
+        self.assertEqual(sizes['subject'], 7)
+        self.assertEqual(sizes['text'], 8)
+        self.assertEqual(sizes['html'], 11)
+        self.assertEqual(sizes['attachment: report.csv'], 3)
+        self.assertTrue(sizes['total'] > sum(sizes.values()) - sizes['total'])
+
+    def test_part_size_status(self):
+        self.assertEqual(PartSize('html', 100).status, '')
+        self.assertEqual(PartSize('html', 80, limit=100).status, '')
+        self.assertEqual(PartSize('html', 81, limit=100).status, 'warning')
+        self.assertEqual(PartSize('html', 101, limit=100).status, 'error')
+
+
+class ExportPreviewsTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        call_command('mailviews_export', self.directory, processes=2,
+            stdout=StringIO())
+
+        path = os.path.join(self.directory, BasicEmailMessageView.__module__)
+        self.assertEqual(sorted(os.listdir(path)), [
+            'BasicHTMLPreview.eml',
+            'BasicHTMLPreview.html',
+            'BasicHTMLPreview.txt',
+            'BasicPreview.eml',
+            'BasicPreview.txt',
+            'CustomizablePreview.eml',
+            'CustomizablePreview.txt',
+        ])
+        with open(os.path.join(path, 'CustomizablePreview.txt')) as f:
+            self.assertEqual(f.read(), 'Sample content')
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox.sqlite3'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_send_later(self):
+        view = BasicEmailMessageView('subject', 'content')
+        view.send_later({'content': 'first'}, outbox=self.outbox,
+            to=('a@disqus.com',))
+        view.send_later({'content': 'second'}, outbox=self.outbox,
+            to=('b@disqus.com',))
+        self.assertEqual(len(self.outbox), 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+        stdout = StringIO()
+        call_command('mailviews_outbox', outbox=self.outbox.path, batch_size=1,
+            stdout=stdout)
+        self.assertIn('Sent 2 messages', stdout.getvalue())
+        self.assertEqual([m.to for m in mail.outbox],
+            [['a@disqus.com'], ['b@disqus.com']])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_lease(self):
+        self.outbox.put(BasicEmailMessageView('subject', 'content'))
+
+        self.outbox.lease = 0  # Leases expire immediately.
+        self.assertEqual([m.attempts for m in self.outbox.claim()], [1])
+        self.assertEqual([m.attempts for m in self.outbox.claim()], [2])
+
+        self.outbox.lease = 300
+        self.assertEqual([m.attempts for m in self.outbox.claim()], [3])
+        self.assertEqual(self.outbox.claim(), [])
+
+    def test_complete_each_message(self):
+        view = BasicEmailMessageView('subject', 'content')
+        for i in range(3):
+            self.outbox.put(view, to=('%s@disqus.com' % i,))
+
+        connection = CrashingEmailBackend()
+        connection.limit = 1
+        self.assertRaises(KeyboardInterrupt, self.outbox.send,
+            self.outbox.claim(), connection)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(self.outbox), 2)
+
+    def test_lease_renewal(self):
+        outbox = self.outbox
+        view = BasicEmailMessageView('subject', 'content')
+        for i in range(2):
+            outbox.put(view, to=('%s@disqus.com' % i,))
+
+        outbox.lease = 0
+        messages = outbox.claim()
+        outbox.lease = 300
+        for message in messages:
+            message.claimed -= outbox.lease  # The leases have expired.
+
+        claimable = []
+
+        class ClaimingEmailBackend(locmem.EmailBackend):
+            def send_messages(self, messages):
+                # Claim messages as another worker would.
+                claimable.append(len(outbox.claim()))
+                return super(ClaimingEmailBackend, self).send_messages(
+                    messages)
+
+        self.assertEqual(outbox.send(messages, ClaimingEmailBackend()), (2, 0))
+        self.assertEqual(claimable, [0, 0])
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_path(self):
+        path = os.path.join(self.directory, 'outbox.sqlite3')
+        with override_settings(MAILVIEWS_OUTBOX=path):
+            self.assertEqual(get_outbox().path, path)
+        with override_settings(BASE_DIR=self.directory):
+            self.assertEqual(get_outbox().path,
+                os.path.join(self.directory, 'mailviews-outbox.sqlite3'))
+        with override_settings(MAILVIEWS_OUTBOX='outbox.sqlite3'):
+            self.assertRaises(ImproperlyConfigured, get_outbox)
+        self.assertEqual(get_outbox('outbox.sqlite3').path,
+            os.path.abspath('outbox.sqlite3'))
+
+    def test_failure(self):
+        self.outbox.retry_delay = 0
+        self.outbox.max_attempts = 2
+        self.outbox.put(TemplatedEmailMessageView())  # This can't be rendered.
+
+        self.assertEqual(self.outbox.drain(), (0, 2))
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+
 class PreviewSiteTestCase(TestCase):
 
     def setUp(self):
@@ -258,6 +1341,23 @@ class PreviewSiteTestCase(TestCase):
         self.assertContains(response, '#body-plain')
         self.assertContains(response, '#raw')
 
+    def test_preview_sizes(self):
+        url = reverse('%s:detail' % URL_NAMESPACE, kwargs={
+            'module': BasicHTMLEmailMessageView.__module__,
+            'preview': BasicHTMLPreview.__name__
+        })
+        response = self.client.get(url)
+        self.assertContains(response, 'id="sizes"')
+        self.assertEqual([size.name for size in response.context['sizes']],
+            ['subject', 'text', 'html', 'total'])
+
+    def test_list_measure(self):
+        response = self.client.get(reverse('%s:list' % URL_NAMESPACE), {'measure': ''})
+        self.assertEqual(response.status_code, 200)
+        for previews in response.context['site']:
+            for preview in previews.previews:
+                self.assertTrue(preview.total_size > 0)
+
     def test_customizable_preview(self):
         url = reverse('%s:detail' % URL_NAMESPACE, kwargs={
             'module': BasicEmailMessageView.__module__,
@@ -267,4 +1367,86 @@ class PreviewSiteTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, '<form')
         self.assertContains(response, '#body-plain')
-        self.assertContains(response, '#raw')
\ No newline at end of file
+        self.assertContains(response, '#raw')
+
+    def get_part_url(self, preview, part):
+        return reverse('%s:part' % URL_NAMESPACE, kwargs={
+            'module': preview.message_view.__module__,
+            'preview': preview.__name__,
+            'part': part,
+        })
+
+    def test_html_part(self):
+        response = self.client.get(self.get_part_url(BasicHTMLPreview, 'html'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+        self.assertContains(response, '<p>')
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+
+        response = self.client.get(self.get_part_url(BasicPreview, 'html'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_part_etag(self):
+        url = self.get_part_url(CustomizablePreview, 'text')
+        query = {'subject': 'subject', 'content': 'content'}
+        response = self.client.get(url, query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'content')
+
+        etag = response['ETag']
+        response = self.client.get(url, query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        query['content'] = 'changed'
+        response = self.client.get(url, query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_parts_from_single_render(self):
+        url = reverse('%s:detail' % URL_NAMESPACE, kwargs={
+            'module': BasicHTMLEmailMessageView.__module__,
+            'preview': BasicHTMLPreview.__name__
+        })
+        response = self.client.get(url)
+        message = response.context['message']
+        parts = response.context['parts']
+        self.assertContains(response, 'data-src="%s"' % parts['source'])
+
+        self.assertContains(response, '<iframe src="%s" sandbox' % parts['html'])
+
+        html = self.client.get(parts['html'])
+        self.assertEqual(html.content.decode('utf-8'),
+            message.alternatives[0][0])
+        self.assertEqual(html['Content-Security-Policy'], 'sandbox')
+        raw = self.client.get(parts['raw']).content
+        self.assertEqual(self.client.get(parts['eml']).content, raw)
+        self.assertEqual(len(raw), response.context['sizes'][-1].size)
+
+    def test_stable_part_urls(self):
+        url = reverse('%s:detail' % URL_NAMESPACE, kwargs={
+            'module': BasicEmailMessageView.__module__,
+            'preview': CustomizablePreview.__name__
+        })
+        query = {'subject': 'subject', 'content': 'content'}
+        first = self.client.get(url, query)
+        second = self.client.get(url, query)
+        self.assertEqual(first.context['parts'], second.context['parts'])
+        self.assertEqual(self.client.get(first.context['parts']['raw']).content,
+            self.client.get(second.context['parts']['raw']).content)
+
+        query['content'] = 'changed'
+        changed = self.client.get(url, query)
+        self.assertNotEqual(first.context['parts']['raw'],
+            changed.context['parts']['raw'])
+
+    def test_invalid_form_part(self):
+        response = self.client.get(self.get_part_url(CustomizablePreview, 'raw'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_eml_part(self):
+        response = self.client.get(self.get_part_url(BasicPreview, 'eml'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'message/rfc822')
+        self.assertEqual(response['Content-Disposition'],
+            'attachment; filename="BasicPreview.eml"')
+        self.assertContains(response, 'Subject: ')
@@ -1,7 +1,20 @@
+import copy
+import hashlib
+import multiprocessing
+import pickle
 import textwrap
+import weakref
 from collections import namedtuple
+from contextlib import contextmanager
+from timeit import default_timer
 
+from django.db import connections
 from django.template import Context
+from django.template.context import BaseContext
+from django.template.base import NodeList
+from django.template.defaulttags import AutoEscapeControlNode
+
+from mailviews.signals import phase_timed
 
 
 Docstring = namedtuple('Docstring', ('summary', 'body'))
@@ -35,6 +48,129 @@ def unescape(context):
     Accepts a context object, returning a new context with autoescape off.
 
     Useful for rendering plain-text templates without having to wrap the entire
-    template in an `{% autoescape off %}` tag.
+    template in an `{% autoescape off %}` tag. Contexts that already have
+    autoescape disabled are returned as-is.
     """
+    if isinstance(context, Context) and not context.autoescape:
+        return context
     return Context(context, autoescape=False)
+
+
+# Maps templates to their equivalent with autoescaping disabled.
+_unescaped_templates = weakref.WeakKeyDictionary()
+
+
+def unescaped_template(template):
+    """
+    Accepts a template object, returning an equivalent template that always
+    renders with autoescape off.
+
+    This has the same effect as wrapping the entire template in an
+    `{% autoescape off %}` tag (or rendering it with an :func:`unescape`
+    context), but the template is only altered once: the result is cached
+    for each template, and can be rendered directly with any context.
+    """
+    try:
+        return _unescaped_templates[template]
+    except KeyError:
+        pass
+
+    # Templates returned by the template loaders in Django 1.8 and above are
+    # wrappers that create a new context (with the engine autoescape setting)
+    # for every render, so the underlying template is used instead.
+    compiled = copy.copy(getattr(template, 'template', template))
+    compiled.nodelist = NodeList([
+        AutoEscapeControlNode(False, compiled.nodelist),
+    ])
+
+    _unescaped_templates[template] = compiled
+    return compiled
+
+
+@contextmanager
+def timed(view, phase):
+    """
+    Times the execution of the wrapped block, sending the
+    :data:`~mailviews.signals.phase_timed` signal for the given message view
+    and phase when it completes.
+
+    Nothing is timed if there aren't any receivers connected to the signal.
+    """
+    if not phase_timed.receivers:
+        yield
+        return
+
+    start = default_timer()
+    yield
+    phase_timed.send(sender=type(view), view=view, phase=phase,
+        duration=default_timer() - start)
+
+
+def flatten(context, exclude=()):
+    """
+    Returns the values contained by a context (and any nested contexts) as a
+    single dictionary, skipping any of the layers in ``exclude``.
+    """
+    flat = {}
+    for values in context.dicts:
+        if any(values is layer for layer in exclude):
+            continue
+        if isinstance(values, BaseContext):
+            values = flatten(values, exclude)
+        flat.update(values)
+    return flat
+
+
+def fingerprint(context, exclude=()):
+    """
+    Returns a digest of the values contained by a context, or ``None`` if the
+    values can't be serialized.
+
+    Contexts with equal fingerprints contain the same names, bound to values
+    of the same types with the same state. Layers of the context that are in
+    ``exclude`` (compared by identity) are not included, which allows a layer
+    shared by many contexts to be fingerprinted once, on its own.
+    """
+    try:
+        data = pickle.dumps(sorted(flatten(context, exclude).items()), 2)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+
+def close_idle_connections():
+    """
+    Closes any database connections that aren't in a transaction.
+
+    Database connections can't be shared with child processes, so this should
+    be called before forking. The closed connections are reopened on demand.
+    (Connections within a transaction are left alone, since closing them would
+    discard the transaction.)
+    """
+    for connection in connections.all():
+        if not getattr(connection, 'in_atomic_block', False):
+            connection.close()
+
+
+@contextmanager
+def worker_pool(processes=None, initializer=None, initargs=()):
+    """
+    Provides a :class:`multiprocessing.Pool` of worker processes for the
+    duration of the wrapped block, closing any idle database connections
+    (with :func:`close_idle_connections`) before the workers are started.
+
+    When the block completes, the pool is closed and its workers are waited
+    for. If the block raises an exception (including ``KeyboardInterrupt``),
+    the workers are terminated instead.
+    """
+    close_idle_connections()
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()